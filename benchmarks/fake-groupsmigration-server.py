@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Local stand-in for Google Groups Migration API (archive.insert of
+groupsmigration v1) and for the OAuth token endpoint, so that
+mailman-to-google-group-message-import.py can be exercised and measured
+without talking to Google.
+
+Point the importer at this server with --api-endpoint http://HOST:PORT/ and
+give it service account credentials whose token_uri is
+http://HOST:PORT/token (message-import-throughput.py generates such
+credentials). GET /stats returns counters of what the server has seen.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+
+from aiohttp import web
+from collections import Counter, defaultdict
+
+MAX_MESSAGE_SIZE = 26214400  # maxSize of archive.insert media uploads
+
+
+def error_response(status, message, headers=None):
+    """Return error response shaped like Google API errors"""
+    body = {"error": {"code": status, "message": message, "errors": [{"message": message}]}}
+    return web.json_response(body, status=status, headers=headers)
+
+
+def make_app(config):
+    """Return aiohttp application that behaves according to config (parsed
+    command line arguments)"""
+    stats = Counter()
+    in_flight = defaultdict(int)  # number of inserts in progress per group
+    rng = random.Random(config.seed)
+    unavailable_headers = {"Retry-After": str(config.retry_after)} if config.retry_after is not None else None
+
+    async def token(request):
+        stats["tokens"] += 1
+        return web.json_response(
+            {"access_token": f"fake-token-{stats['tokens']}", "expires_in": 3600, "token_type": "Bearer"}
+        )
+
+    async def insert(request):
+        group = request.match_info["group"]
+        stats["requests"] += 1
+        if not request.headers.get("Authorization", "").startswith("Bearer fake-token-"):
+            stats["unauthorized"] += 1
+            return error_response(401, "Request had invalid authentication credentials")
+        body = await request.read()
+        if len(body) > config.max_size:
+            stats["too_large"] += 1
+            return error_response(413, "Request Too Large")
+
+        in_flight[group] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], sum(in_flight.values()))
+        try:
+            parallel = in_flight[group] > 1
+            await asyncio.sleep(max(0, rng.gauss(config.latency, config.latency_jitter)))
+            if config.reject_parallel and parallel:
+                stats["rejected_parallel"] += 1
+                return error_response(503, "Backend Error", unavailable_headers)
+            if rng.random() < config.unavailable_rate:
+                stats["unavailable"] += 1
+                return error_response(503, "Backend Error", unavailable_headers)
+        finally:
+            in_flight[group] -= 1
+
+        stats["accepted"] += 1
+        stats["bytes"] += len(body)
+        return web.json_response({"kind": "groupsmigration#groups", "responseCode": "SUCCESS"})
+
+    async def get_stats(request):
+        return web.json_response(dict(stats))
+
+    app = web.Application(client_max_size=config.max_size * 2)
+    app.router.add_post("/token", token)
+    app.router.add_post("/upload/groups/v1/groups/{group}/archive", insert)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--port",
+        default=8080,
+        type=int,
+        help="port to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        metavar="SEC",
+        default=0.3,
+        type=float,
+        help="mean time to process an insert (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency-jitter",
+        metavar="SEC",
+        default=0.1,
+        type=float,
+        help="standard deviation of insert time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--unavailable-rate",
+        metavar="FRACTION",
+        default=0,
+        type=float,
+        help="fraction of inserts to fail with 503 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--retry-after",
+        metavar="SEC",
+        type=int,
+        help="send Retry-After header with 503 responses",
+    )
+    parser.add_argument(
+        "--max-size",
+        metavar="BYTES",
+        default=MAX_MESSAGE_SIZE,
+        type=int,
+        help="reject larger uploads with 413 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--reject-parallel",
+        action="store_true",
+        help="fail with 503 inserts into a group that has another insert in progress",
+    )
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="random seed (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    print(f"serving on http://{args.host}:{args.port}/ with {json.dumps(vars(args))}", flush=True)
+    web.run_app(make_app(args), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Measure per-message overhead of the Dispatcher of
+mailman-to-google-group-message-import.py using workers that don't do any
+work, i.e. the cost of scheduling alone, without any network requests.
+"""
+import argparse
+import importlib.util
+import sys
+
+from pathlib import Path
+from time import perf_counter
+
+IMPORTER_PATH = Path(__file__).resolve().parent.parent / "mailman-to-google-group-message-import.py"
+
+
+def load_importer():
+    sys.path.insert(0, str(IMPORTER_PATH.parent))  # for the importer's own imports
+    spec = importlib.util.spec_from_file_location("message_import", IMPORTER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # so that multiprocessing can pickle its classes
+    spec.loader.exec_module(module)
+    return module
+
+
+def null_worker(work_q, feedback_q, worker_id):
+    """Report every message as successfully imported right away"""
+    while True:
+        msg = work_q.get()
+        if msg is None:
+            return
+        feedback_q.put((worker_id, True, msg, []))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--num-messages",
+        metavar="NUM",
+        default=100000,
+        type=int,
+        help="number of messages to dispatch (default: 100000)",
+    )
+    parser.add_argument(
+        "--num-workers",
+        metavar="NUM",
+        default=[1, 4, 16],
+        type=int,
+        nargs="+",
+        help="worker counts to benchmark (default: 1 4 16)",
+    )
+    parser.add_argument(
+        "--worker-credit",
+        metavar="NUM",
+        default=[1, 4],
+        type=int,
+        nargs="+",
+        help="per-worker credits to benchmark (default: 1 4)",
+    )
+    args = parser.parse_args()
+
+    importer = load_importer()
+    print(f"{'workers':>8} {'credit':>8} {'msgs/s':>12} {'us/msg':>10}")
+    for num_workers in args.num_workers:
+        for credit in args.worker_credit:
+            dispatcher = importer.Dispatcher(null_worker, (), num_workers, credit)
+            dispatcher.start()
+            try:
+                start = perf_counter()
+                processed = dispatcher.run(range(args.num_messages), lambda success, msg, attempts: None)
+                elapsed = perf_counter() - start
+            finally:
+                dispatcher.stop()
+            assert processed == args.num_messages
+            rate = processed / elapsed
+            print(f"{num_workers:>8} {credit:>8} {rate:>12.0f} {1e6 / rate:>10.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
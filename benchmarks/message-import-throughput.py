@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Measure end-to-end throughput of mailman-to-google-group-message-import.py
+against fake-groupsmigration-server.py, across engines, worker counts and
+archive sizes.
+
+For every combination, a fresh fake server is started, a synthetic archive
+is imported into it with the importer (run as a separate process, exactly
+like in production, except for --api-endpoint and made-up service account
+credentials), and the importer's own metrics and the server's counters are
+summarized in a table.
+"""
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import urllib.request
+
+from itertools import product
+from pathlib import Path
+from time import perf_counter, sleep
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+IMPORTER_PATH = BENCHMARKS_DIR.parent / "mailman-to-google-group-message-import.py"
+SERVER_PATH = BENCHMARKS_DIR / "fake-groupsmigration-server.py"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_mbox(path, num_messages, message_size):
+    """Write synthetic mbox mailbox of num_messages messages, each with a body
+    of about message_size bytes"""
+    line = b"The quick brown fox jumps over the lazy dog. 0123456789\n"
+    body = line * (message_size // len(line) + 1)
+    with open(path, "wb") as f:
+        for i in range(num_messages):
+            f.write(
+                b"From bench@example.com Mon Jan  1 00:00:00 2024\n"
+                b"From: bench@example.com\n"
+                b"Date: Mon, 01 Jan 2024 00:00:00 +0000\n"
+                b"Message-ID: <%d.bench@example.com>\n"
+                b"Subject: benchmark message %d\n\n" % (i, i) + body + b"\n"
+            )
+
+
+def write_fake_credentials(path, token_uri):
+    """Write service account credentials JSON with a throwaway key whose
+    tokens come from token_uri"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    creds = {
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": pem.decode(),
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+    Path(path).write_text(json.dumps(creds))
+
+
+def get_json(url):
+    with urllib.request.urlopen(url) as resp:
+        return json.load(resp)
+
+
+def start_server(port, server_args):
+    server = subprocess.Popen(
+        [sys.executable, SERVER_PATH, "--port", str(port)] + server_args, stdout=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            get_json(f"http://127.0.0.1:{port}/stats")
+            return server
+        except OSError:
+            sleep(0.05)
+    server.kill()
+    raise RuntimeError("fake server did not start")
+
+
+def run_import(tmpdir, mbox_path, engine, num_workers, args):
+    """Import mbox_path into a fresh fake server and return a dict with the
+    results"""
+    port = free_port()
+    endpoint = f"http://127.0.0.1:{port}/"
+    creds_path = tmpdir / "creds.json"
+    write_fake_credentials(creds_path, endpoint + "token")
+    server_args = ["--latency", str(args.latency), "--latency-jitter", str(args.latency_jitter)]
+    server_args += ["--unavailable-rate", str(args.unavailable_rate)]
+    server_args += ["--reject-parallel"] if args.reject_parallel else []
+    metrics_path = tmpdir / f"metrics-{port}.jsonl"
+    server = start_server(port, server_args)
+    try:
+        cmd = [sys.executable, IMPORTER_PATH, "--sa-creds", creds_path, "--sa-delegator", "bench@example.com"]
+        cmd += ["--src-mbox", mbox_path, "--dst-group", "bench@example.com", "--api-endpoint", endpoint]
+        cmd += ["--work-dir", tmpdir / f"work-{port}", "--stream", "--engine", engine]
+        cmd += ["--journal", tmpdir / f"journal-{port}.sqlite"]
+        cmd += ["--num-workers", str(num_workers), "--max-rate", str(args.max_rate)]
+        cmd += ["--metrics-file", metrics_path, "--metrics-interval", "3600", "--log-level", "warning"]
+        start = perf_counter()
+        subprocess.run(cmd, check=True)
+        elapsed = perf_counter() - start
+        server_stats = get_json(endpoint + "stats")
+    finally:
+        server.terminate()
+        server.wait()
+    metrics = json.loads(metrics_path.read_text().splitlines()[-1])
+    return {
+        "elapsed": elapsed,
+        "imported": metrics["counts"].get("imported", 0),
+        "p50": metrics["latency"].get("all", {}).get("p50") or 0,
+        "p95": metrics["latency"].get("all", {}).get("p95") or 0,
+        "retries": metrics["counts"].get("retries", 0),
+        "server": server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--num-messages",
+        metavar="NUM",
+        default=[100, 1000],
+        type=int,
+        nargs="+",
+        help="archive sizes to benchmark (default: 100 1000)",
+    )
+    parser.add_argument(
+        "--message-size",
+        metavar="BYTES",
+        default=4096,
+        type=int,
+        help="approximate size of each message (default: 4096)",
+    )
+    parser.add_argument(
+        "--num-workers",
+        metavar="NUM",
+        default=[1, 4, 16],
+        type=int,
+        nargs="+",
+        help="worker counts to benchmark (default: 1 4 16)",
+    )
+    parser.add_argument(
+        "--engine",
+        default=["processes", "asyncio"],
+        choices=("processes", "asyncio"),
+        nargs="+",
+        help="importer engines to benchmark (default: processes asyncio)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        metavar="NUM",
+        default=1000,
+        type=float,
+        help="importer's --max-rate (default: 1000)",
+    )
+    parser.add_argument(
+        "--latency",
+        metavar="SEC",
+        default=0.05,
+        type=float,
+        help="fake server's mean insert latency (default: 0.05)",
+    )
+    parser.add_argument(
+        "--latency-jitter",
+        metavar="SEC",
+        default=0.01,
+        type=float,
+        help="standard deviation of fake server's insert latency (default: 0.01)",
+    )
+    parser.add_argument(
+        "--unavailable-rate",
+        metavar="FRACTION",
+        default=0,
+        type=float,
+        help="fraction of inserts the fake server fails with 503 (default: 0)",
+    )
+    parser.add_argument(
+        "--reject-parallel",
+        action="store_true",
+        help="make the fake server reject parallel inserts into a group",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'engine':>10} {'workers':>8} {'msgs':>8} {'secs':>8} {'msgs/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'retries':>8} {'503s':>8} {'imported':>8}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        tmpdir = Path(tmp)
+        for num_messages in args.num_messages:
+            mbox_path = tmpdir / f"{num_messages}.mbox"
+            write_mbox(mbox_path, num_messages, args.message_size)
+            for engine, num_workers in product(args.engine, args.num_workers):
+                res = run_import(tmpdir, mbox_path, engine, num_workers, args)
+                num_503 = res["server"].get("unavailable", 0) + res["server"].get("rejected_parallel", 0)
+                print(
+                    f"{engine:>10} {num_workers:>8} {num_messages:>8} {res['elapsed']:>8.1f} "
+                    f"{num_messages / res['elapsed']:>8.1f} {res['p50'] * 1000:>8.0f} "
+                    f"{res['p95'] * 1000:>8.0f} {res['retries']:>8} {num_503:>8} {res['imported']:>8}",
+                    flush=True,
+                )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
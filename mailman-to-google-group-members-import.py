@@ -1,17 +1,377 @@
 #!/usr/bin/env python
 import argparse
+import json
 import sys
 import logging
 import pickle
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
 # noinspection PyPackageRequirements
 from google.oauth2 import service_account
 # noinspection PyPackageRequirements
 from googleapiclient import discovery
-# noinspection PyPackageRequirements
-from googleapiclient.errors import HttpError
 
-from utils import get_google_group_config_from_mailman_config
+from utils import (
+    GOOGLE_API_BUDGETS,
+    EmailIndex,
+    TokenBucketRateLimiter,
+    canonical_email,
+    format_email_entries,
+)
+
+# Maximum number of calls in one Directory API batch request
+DIRECTORY_BATCH_SIZE = 1000
+# Maximum number of members per page of members.list
+MEMBERS_PAGE_SIZE = 200
+
+DIRECTORY_MEMBER_SCOPE = "https://www.googleapis.com/auth/admin.directory.group.member"
+
+EMAIL_REGEX = r"^[a-zA-Z0-9._%+-=]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+
+
+class BatchRequests:
+    """Queue Directory API requests and execute them in batch HTTP requests
+    of up to batch_size calls each, instead of one round-trip per call.
+
+    Google counts every call of a batch against quota, so every call of a
+    batch is charged to the "directory" budget of ratelimiter, all at once
+    right before the batch is sent; batch_size must not exceed the budget's
+    burst. Requests of a batch may be executed by Google in any order, so
+    requests whose outcome depends on each other must be separated by
+    execute().
+    """
+
+    def __init__(self, svc, ratelimiter, batch_size=GOOGLE_API_BUDGETS["directory"][1]):
+        self.svc = svc
+        self.ratelimiter = ratelimiter
+        self.batch_size = batch_size
+        self.batch = None
+        self.num_queued = 0
+        self.errors = []
+
+    def add(self, request, on_error):
+        """Queue request. If it fails, on_error(exception) will be called from
+        execute(). If on_error raises an exception, the first one propagates
+        from execute() once on_error has been called for every failed request
+        of the batch."""
+        if self.batch is None:
+            self.batch = self.svc.new_batch_http_request()
+
+        def callback(request_id, response, exception):
+            # an exception raised here would skip callbacks of the rest of the batch
+            if exception is not None:
+                try:
+                    on_error(exception)
+                except Exception as e:
+                    self.errors.append(e)
+
+        self.batch.add(request, callback=callback)
+        self.num_queued += 1
+        if self.num_queued >= self.batch_size:
+            self.execute()
+
+    def execute(self):
+        """Execute queued requests"""
+        if self.batch is None:
+            return
+        batch, self.batch = self.batch, None
+        logging.debug(f"Executing batch of {self.num_queued} requests")
+        self.ratelimiter.acquire("directory", self.num_queued)
+        self.num_queued = 0
+        batch.execute()
+        if self.errors:
+            error, self.errors = self.errors[0], []
+            raise error
+
+
+def on_insert_error(member, exception):
+    if exception.status_code == 409:  # entity already exists
+        logging.error(f"User {member} already part of the group")
+    else:
+        raise exception
+
+
+def on_manager_insert_error(owner, exception):
+    if exception.status_code == 409:  # entity already exists
+        logging.error(f"User {owner} already part of the group")
+        logging.warning("!!!")
+        logging.warning(f"!!!  CONFIGURE AS MANAGER MANUALLY: {owner}")
+        logging.warning("!!!")
+
+
+def on_nonmember_insert_error(nonmember, exception):
+    if exception.status_code == 409:  # entity already exists
+        logging.error(f"User {nonmember} already part of the group; 'delivery_settings' not updated")
+        logging.warning(f"!!!  SET 'delivery_settings' MANUALLY FOR {nonmember}")
+
+
+# Insert error handler for members planned for each reason
+INSERT_ERROR_HANDLERS = {
+    "digest member": on_insert_error,
+    "regular member": on_insert_error,
+    "non-member manager": on_manager_insert_error,
+    "non-member": on_nonmember_insert_error,
+}
+
+
+def plan_membership(mmcfg, ignore):
+    """Return membership plan of Google group of mailman list mmcfg, made in
+    a single pass over the list's addresses. The plan is a JSON-serializable
+    dict with keys:
+        group: email of the group
+        members: dict of canonical email (see canonical_email()) -> dict with
+            the email, role, delivery_settings and reason (kind of mailman
+            entry) of a member
+        skipped: dict of email -> why it isn't in members
+        collisions: dict of canonical email -> [email, source] entries of
+            addresses listed more than once (see EmailIndex.collisions())
+
+    Variants of an address (e.g. differing only in case) are one member. The
+    first of digest member, regular member, non-member manager (owner or
+    moderator), and accepted non-member entries of an address determines its
+    email and delivery settings; owners and moderators become managers.
+    """
+    ignore = EmailIndex(ignore)
+    managers = EmailIndex(mmcfg["owner"] + mmcfg["moderator"])
+    index = EmailIndex()
+    entries = [(member, "digest_members", "digest member", "DIGEST") for member in mmcfg["digest_members"]]
+    entries += [
+        (member, "regular_members", "regular member", "ALL_MAIL") for member in mmcfg["regular_members"]
+    ]
+    entries += [(owner, "owner", "non-member manager", "NONE") for owner in mmcfg["owner"]]
+    entries += [(moderator, "moderator", "non-member manager", "NONE") for moderator in mmcfg["moderator"]]
+    entries += [
+        (nonmember, "accept_these_nonmembers", "non-member", "NONE")
+        for nonmember in mmcfg["accept_these_nonmembers"]
+    ]
+
+    plan = {"group": mmcfg["email"], "members": {}, "skipped": {}}
+    for email, source, reason, delivery_settings in entries:
+        if email in ignore:
+            plan["skipped"][email] = "on the ignore list"
+            continue
+        if reason == "non-member" and not re.match(EMAIL_REGEX, email):
+            plan["skipped"][email] = "invalid non-member email"
+            continue
+        key = index.add(email, source)
+        if key not in plan["members"]:
+            plan["members"][key] = {
+                "email": email,
+                "role": "MANAGER" if email in managers else "MEMBER",
+                "delivery_settings": delivery_settings,
+                "reason": reason,
+            }
+    plan["collisions"] = index.collisions()
+    return plan
+
+
+def insert_members(plan, members, batch):
+    """Insert members of membership plan into its group, leaving those already
+    in the group as they are (see log for details)"""
+    for member in plan["members"].values():
+        email, reason = member["email"], member["reason"]
+        if reason == "non-member":
+            logging.info(f"Inserting mailman non-member {email} as no-delivery member")
+        else:
+            role = " (manager)" if member["role"] == "MANAGER" else ""
+            logging.info(f"Inserting {reason} {email}{role}")
+        body = {"email": email, "role": member["role"], "delivery_settings": member["delivery_settings"]}
+        batch.add(
+            members.insert(groupKey=plan["group"], body=body),
+            partial(INSERT_ERROR_HANDLERS[reason], email),
+        )
+    batch.execute()
+
+
+def list_group_members(members, group, ratelimiter):
+    """Return dict of canonical email -> member resource (with only email,
+    role and delivery_settings fields) of every member of group"""
+    current = {}
+    request = members.list(
+        groupKey=group,
+        maxResults=MEMBERS_PAGE_SIZE,
+        fields="nextPageToken,members(email,role,delivery_settings)",
+    )
+    while request is not None:
+        ratelimiter.acquire("directory")
+        response = request.execute()
+        for member in response.get("members", []):
+            if "email" in member:
+                current[canonical_email(member["email"])] = member
+        request = members.list_next(request, response)
+    return current
+
+
+def on_sync_error(action, email, exception):
+    logging.error(f"Failed to {action} {email}: {exception}")
+
+
+def sync_members(plan, members, batch, delete_extra):
+    """Make members of the group of membership plan match the plan by fetching
+    the group's member list once and then inserting missing members and
+    patching role and delivery settings of existing ones, as needed. Owners
+    keep their role. If delete_extra, remove members that are not in the
+    plan, except for owners and skipped addresses. Return whether the group
+    will have any managers."""
+    group, desired = plan["group"], plan["members"]
+    current = list_group_members(members, group, batch.ratelimiter)
+    logging.info(f"Group has {len(current)} members; mailman list has {len(desired)}")
+    num_unchanged = 0
+    for key, planned in desired.items():
+        member = current.get(key)
+        if member is None:
+            logging.info(f"Inserting {planned['reason']} {planned['email']} as {planned['role'].lower()}")
+            body = {field: planned[field] for field in ("email", "role", "delivery_settings")}
+            batch.add(
+                members.insert(groupKey=group, body=body),
+                partial(on_sync_error, "insert", planned["email"]),
+            )
+            continue
+        changes = {}
+        if member.get("role") not in ("OWNER", planned["role"]):
+            changes["role"] = planned["role"]
+        if member.get("delivery_settings") != planned["delivery_settings"]:
+            changes["delivery_settings"] = planned["delivery_settings"]
+        if changes:
+            logging.info(f"Updating {member['email']}: {changes}")
+            batch.add(
+                members.patch(groupKey=group, memberKey=member["email"], body=changes),
+                partial(on_sync_error, "update", member["email"]),
+            )
+        else:
+            num_unchanged += 1
+
+    extra = current.keys() - desired.keys() - {canonical_email(email) for email in plan["skipped"]}
+    for key in sorted(extra):
+        member = current[key]
+        if not delete_extra:
+            logging.info(f"Keeping {member['email']}, who is not on the mailman list")
+        elif member.get("role") == "OWNER":
+            logging.info(f"Keeping owner {member['email']}, who is not on the mailman list")
+        else:
+            logging.info(f"Removing {member['email']}")
+            batch.add(
+                members.delete(groupKey=group, memberKey=member["email"]),
+                partial(on_sync_error, "remove", member["email"]),
+            )
+    batch.execute()
+    logging.info(f"{num_unchanged} members were already up to date")
+
+    roles = {key: planned["role"] for key, planned in desired.items()}
+    for key, member in current.items():
+        if member.get("role") == "OWNER" or (key not in desired and not (delete_extra and key in extra)):
+            roles[key] = member.get("role")
+    return bool({"OWNER", "MANAGER"} & set(roles.values()))
+
+
+class DirectoryClientPool:
+    """Pool of Directory API clients that share credentials, for use by
+    concurrent threads. googleapiclient service objects are not thread-safe,
+    so a client is lent to one thread at a time; clients are built on demand
+    and reused, so there are never more of them than concurrent borrowers."""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.idle = queue.SimpleQueue()
+
+    @contextmanager
+    def client(self):
+        try:
+            svc = self.idle.get_nowait()
+        except queue.Empty:
+            svc = discovery.build(
+                "admin", "directory_v1", credentials=self.credentials, cache_discovery=False
+            )
+        try:
+            yield svc
+        finally:
+            self.idle.put(svc)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def read_plan(args, mailman_pickle=None):
+    """Return membership plan from args.apply_plan or made from mailman_pickle
+    (by default args.mailman_pickle)"""
+    if args.apply_plan:
+        logging.info(f"Reading membership plan from {args.apply_plan}")
+        plan = json.loads(Path(args.apply_plan).read_text())
+    else:
+        mailman_pickle = mailman_pickle or args.mailman_pickle
+        logging.info(f"Retrieving mailman list configuration from {mailman_pickle}")
+        with open(mailman_pickle, "rb") as f:
+            mmcfg = pickle.load(f)
+        plan = plan_membership(mmcfg, args.ignore)
+    for email, reason in plan["skipped"].items():
+        if reason == "on the ignore list":
+            logging.info(f"Skipping {email} ({reason})")
+        else:
+            logging.warning(f"Ignoring {email} ({reason})")
+    for key, entries in plan.get("collisions", {}).items():
+        logging.warning(
+            f"Treating {format_email_entries(entries)} as one member {plan['members'][key]['email']}"
+        )
+    logging.info(f"Planned {len(plan['members'])} members of {plan['group']}")
+    return plan
+
+
+def import_group(plan, svc, ratelimiter, args):
+    """Apply membership plan using Directory API client svc, as configured by
+    command line arguments args"""
+    members = svc.members()
+    batch = BatchRequests(svc, ratelimiter, args.batch_size)
+    if args.sync:
+        logging.info(f"Synchronizing members of {plan['group']} with the plan")
+        group_has_managers = sync_members(plan, members, batch, args.delete_extra)
+    else:
+        insert_members(plan, members, batch)
+        group_has_managers = any(member["role"] == "MANAGER" for member in plan["members"].values())
+
+    if not group_has_managers:
+        logging.warning("!!!")
+        logging.warning(f"Group has no managers. Nobody can approve messages and membership requests.")
+        logging.warning("!!!")
+
+    addr, domain = plan["group"].split("@")
+    logging.info(
+        f"Group member list can be found at https://groups.google.com/u/"
+        f"{args.browser_google_account_index}/a/{domain}/g/{addr}/members"
+    )
+
+
+def import_list(mailman_pickle, pool, ratelimiter, args):
+    """Import members of mailman_pickle in a thread of import_lists()"""
+    threading.current_thread().name = Path(mailman_pickle).stem
+    plan = read_plan(args, mailman_pickle)
+    with pool.client() as svc:
+        import_group(plan, svc, ratelimiter, args)
+
+
+def import_lists(pickle_dir, pool, ratelimiter, args):
+    """Import members of every mailman list pickle (*.pkl) in pickle_dir,
+    up to args.max_groups groups at a time, using clients of pool under the
+    common rate budgets of ratelimiter. Return the number of failed lists."""
+    pickles = sorted(Path(pickle_dir).glob("*.pkl"))
+    logging.info(f"Importing members of {len(pickles)} lists, up to {args.max_groups} at a time")
+    failed = []
+    with ThreadPoolExecutor(args.max_groups) as executor:
+        futures = {executor.submit(import_list, path, pool, ratelimiter, args): path for path in pickles}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Failed to import members of {futures[future].stem}: {repr(e)}")
+                failed.append(futures[future].stem)
+    if failed:
+        logging.error(f"{len(failed)} lists failed to import: {' '.join(sorted(failed))}")
+    return len(failed)
 
 
 def main():
@@ -27,9 +387,36 @@ def main():
     parser.add_argument(
         "--mailman-pickle",
         metavar="PATH",
-        required=True,
         help="mailman list configuration pickle created by pickle-mailman-list.py",
     )
+    parser.add_argument(
+        "--pickle-dir",
+        metavar="DIR",
+        help="import members of every mailman list pickle (*.pkl) in DIR\n"
+        "instead of --mailman-pickle, into up to --max-groups groups\n"
+        "at a time",
+    )
+    parser.add_argument(
+        "--max-groups",
+        metavar="NUM",
+        type=int,
+        default=8,
+        help="maximum number of groups to work on concurrently with\n"
+        "--pickle-dir (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--write-plan",
+        metavar="PATH",
+        help="write membership plan (email -> role, delivery settings and\n"
+        "reason) made from --mailman-pickle to PATH as JSON and exit\n"
+        "without contacting Google",
+    )
+    parser.add_argument(
+        "--apply-plan",
+        metavar="PATH",
+        help="apply membership plan written by --write-plan instead of\n"
+        "planning from --mailman-pickle",
+    )
     parser.add_argument(
         "--ignore",
         metavar="EMAIL",
@@ -40,15 +427,43 @@ def main():
     parser.add_argument(
         "--sa-creds",
         metavar="PATH",
-        required=True,
         help="service account credentials JSON²",
     )
     parser.add_argument(
         "--sa-delegate",
         metavar="EMAIL",
-        required=True,
         help="the principal whom the service account will impersonate³",
     )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="instead of inserting every member and leaving existing\n"
+        "ones alone, fetch the group's member list and only insert\n"
+        "missing members and update role and delivery settings\n"
+        "that differ from the mailman list",
+    )
+    parser.add_argument(
+        "--delete-extra",
+        action="store_true",
+        help="with --sync, also remove group members that are not on\n"
+        "the mailman list (except owners and --ignore addresses)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        metavar="NUM",
+        type=int,
+        default=GOOGLE_API_BUDGETS["directory"][1],
+        help="number of calls per batch HTTP request; all calls of a batch\n"
+        f"are charged to --max-rate at once (default: %(default)s, max: {DIRECTORY_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--max-rate",
+        metavar="NUM",
+        type=float,
+        default=GOOGLE_API_BUDGETS["directory"][0],
+        help="maximum number of Directory API calls per second,\n"
+        "counting every call of a batch (default: %(default)s)",
+    )
     parser.add_argument(
         "--log-level",
         default="info",
@@ -66,122 +481,43 @@ def main():
         "like https://groups.google.com/u/NUM/... (default: 0)",
     )
     args = parser.parse_args()
+    if [bool(args.mailman_pickle), bool(args.apply_plan), bool(args.pickle_dir)].count(True) != 1:
+        parser.error("exactly one of --mailman-pickle, --apply-plan and --pickle-dir is required")
+    if args.write_plan and not args.mailman_pickle:
+        parser.error("--write-plan requires --mailman-pickle")
+    if not args.write_plan and not (args.sa_creds and args.sa_delegate):
+        parser.error("--sa-creds and --sa-delegate are required unless --write-plan is given")
+    if args.delete_extra and not args.sync:
+        parser.error("--delete-extra requires --sync")
+    if not 1 <= args.batch_size <= DIRECTORY_BATCH_SIZE:
+        parser.error(f"--batch-size must be between 1 and {DIRECTORY_BATCH_SIZE}")
 
     logging.basicConfig(
         level=getattr(logging, args.log_level.upper()),
-        format="%(levelname)s %(message)s",
+        format=f"%(levelname)s {'[%(threadName)s] ' if args.pickle_dir else ''}%(message)s",
     )
 
-    logging.info(f"Retrieving mailman list configuration from {args.mailman_pickle}")
-    with open(args.mailman_pickle, "rb") as f:
-        mmcfg = pickle.load(f)
-
-    logging.info("Converting mailman list settings to google group settings")
-    ggcfg = get_google_group_config_from_mailman_config(mmcfg)
+    if args.write_plan:
+        plan = read_plan(args)
+        Path(args.write_plan).write_text(json.dumps(plan, indent=2, sort_keys=True) + "\n")
+        logging.info(f"Membership plan written to {args.write_plan}")
+        return
 
-    scopes = ["https://www.googleapis.com/auth/admin.directory.group.member"]
     creds = service_account.Credentials.from_service_account_file(
-        args.sa_creds, scopes=scopes, subject=args.sa_delegate
+        args.sa_creds, scopes=[DIRECTORY_MEMBER_SCOPE], subject=args.sa_delegate
     )
+    pool = DirectoryClientPool(creds)
+    burst = max(GOOGLE_API_BUDGETS["directory"][1], int(args.max_rate), args.batch_size)
+    ratelimiter = TokenBucketRateLimiter(GOOGLE_API_BUDGETS | {"directory": (args.max_rate, burst)})
 
-    svc = discovery.build("admin", "directory_v1", credentials=creds, cache_discovery=False)
-    members = svc.members()
-
-    group_has_managers = False
-
-    # The flow for populating members and designating managers is a little
-    # weird to work around a Google API bug where members.get() fails sometimes:
-    # https://stackoverflow.com/questions/66992809/google-admin-sdk-directory-api-members-get-returns-a-404-for-member-email-but
-
-    for member in mmcfg["digest_members"]:
-        if member in args.ignore:
-            logging.info(f"Skipping digest member {member} (on the ignore list)")
-            continue
-        body = {"email": member, "delivery_settings": "DIGEST"}
-        if member in set(mmcfg["owner"] + mmcfg["moderator"]):
-            group_has_managers = True
-            logging.info(f"Inserting digest member {member} (manager)")
-            body["role"] = "MANAGER"
-        else:
-            logging.info(f"Inserting digest member {member}")
-        try:
-            members.insert(groupKey=ggcfg["email"], body=body).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {member} already part of the group")
-            else:
-                raise
-
-    for member in mmcfg["regular_members"]:
-        if member in args.ignore:
-            logging.info(f"Skipping member {member} (on the ignore list)")
-            continue
-        body = {"email": member, "delivery_settings": "ALL_MAIL"}
-        if member in set(mmcfg["owner"] + mmcfg["moderator"]):
-            group_has_managers = True
-            logging.info(f"Inserting member {member} (manager)")
-            body["role"] = "MANAGER"
-        else:
-            logging.info(f"Inserting member {member}")
-        try:
-            members.insert(groupKey=ggcfg["email"], body=body).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {member} already part of the group")
-            else:
-                raise
-
-    for owner in set(mmcfg["owner"] + mmcfg["moderator"]) - set(
-        mmcfg["digest_members"] + mmcfg["regular_members"]
-    ):
-        if owner in args.ignore:
-            logging.info(f"Skipping non-member manager {owner} (on the ignore list)")
-            continue
-        logging.info(f"Inserting non-member manager {owner}")
-        group_has_managers = True
-        try:
-            members.insert(
-                groupKey=ggcfg["email"],
-                body={"email": owner, "role": "MANAGER", "delivery_settings": "NONE"},
-            ).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {owner} already part of the group")
-                logging.warning("!!!")
-                logging.warning(f"!!!  CONFIGURE AS MANAGER MANUALLY: {owner}")
-                logging.warning("!!!")
-
-    email_regex = r"^[a-zA-Z0-9._%+-=]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
-    for nonmember in mmcfg["accept_these_nonmembers"]:
-        if nonmember in args.ignore:
-            logging.info(f"Skipping non-member {nonmember} (on the ignore list)")
-            continue
-        if not re.match(email_regex, nonmember):
-            logging.warning(f"Ignoring invalid non-member email {nonmember}")
-            continue
-        logging.info(f"Inserting mailman non-member {nonmember} as no-delivery member")
-        try:
-            members.insert(
-                groupKey=ggcfg["email"],
-                body={"email": nonmember, "delivery_settings": "NONE"},
-            ).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {nonmember} already part of the group; 'delivery_settings' not updated")
-                logging.warning(f"!!!  SET 'delivery_settings' MANUALLY FOR {nonmember}")
-
-    svc.close()
-
-    if not group_has_managers:
-        logging.warning("!!!")
-        logging.warning(f"Group has no managers. Nobody can approve messages and membership requests.")
-        logging.warning("!!!")
-
-    addr, domain = ggcfg["email"].split("@")
-    logging.info(
-        f"Group member list can be found at https://groups.google.com/u/"
-        f"{args.browser_google_account_index}/a/{domain}/g/{addr}/members"
-    )
+    try:
+        if args.pickle_dir:
+            return 1 if import_lists(args.pickle_dir, pool, ratelimiter, args) else 0
+        plan = read_plan(args)
+        with pool.client() as svc:
+            import_group(plan, svc, ratelimiter, args)
+    finally:
+        pool.close()
 
 
 if __name__ == "__main__":
@@ -8,23 +8,123 @@ API doesn't support parallel insertions. Empirically, sometimes it works, other
 times it doesn't work.
 """
 import argparse
+import asyncio
+import cProfile
+import email.errors
+import email.generator
+import email.header
+import email.parser
+import email.policy
+import email.utils
+import gzip
+import hashlib
+import heapq
+import importlib
+import io
+import itertools
+import json
 import logging
-import mailbox
+import lzma
+import mmap
+import multiprocessing.connection
 import os
+import pstats
+import queue
+import random
+import re
+import sqlite3
+import struct
 import sys
+import threading
+import urllib.parse
 
+from google.auth.transport.requests import Request
+import google.oauth2.credentials
 from google.oauth2 import service_account
 from googleapiclient import discovery
-from googleapiclient.errors import HttpError, MediaUploadSizeError
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaInMemoryUpload
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from multiprocessing import Process, Queue
+from multiprocessing.managers import BaseManager
 from pathlib import Path
-from time import time, sleep, perf_counter
+from time import monotonic, sleep, perf_counter, time
+
+from utils import GOOGLE_API_BUDGETS, TokenBucketRateLimiter
 
 
 class WorkingDirectoryNotEmpty(Exception):
     pass
 
 
+class IndexMismatch(Exception):
+    pass
+
+
+class ImportAborted(Exception):
+    pass
+
+
+class MessageTooBig(Exception):
+    pass
+
+
+class MessageUnfixable(Exception):
+    pass
+
+
+class MboxMessage(namedtuple("MboxMessage", "index offset length digest")):
+    """Message number "index" of an mbox mailbox, located at byte offset and of
+    length bytes. digest is that of its Message-ID (see get_message_id_digest())."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"#{self.index}@{self.offset}+{self.length}"
+
+
+class StreamedMessage(namedtuple("StreamedMessage", "index content")):
+    """Message number "index" of a compressed mbox mailbox, decompressed into
+    memory (see stream_compressed_mbox())"""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"#{self.index}"
+
+
+# http_status is None if the request failed without a response, response_code
+# is the responseCode of the response body if there was one
+Attempt = namedtuple("Attempt", "http_status response_code latency retry_after", defaults=(None,))
+
+NO_MESSAGE_ID = bytes(16)
+
+MIGRATION_SCOPE = "https://www.googleapis.com/auth/apps.groups.migration"
+MIGRATION_API_ENDPOINT = "https://groupsmigration.googleapis.com/"
+MIGRATION_UPLOAD_PATH = "upload/groups/v1/groups/{group}/archive"
+MAX_MESSAGE_SIZE = 26214400  # maxSize of archive.insert media uploads
+SHRINK_PLACEHOLDER = (
+    "[This part of the original message ({content_type}{filename}, {size} bytes) was removed\n"
+    "during migration to Google Groups because the message was too big to import.]\n"
+)
+MAX_RETRIES = 5  # how many times to retry a message after a retryable failure
+RETRY_BASE_DELAY = 1  # seconds; retry delays double from this
+RETRY_MAX_DELAY = 60  # seconds
+SYNTHETIC_MSGID_DOMAIN = "mailman-import.invalid"  # of Message-IDs made up for messages without one
+ADDRESS_HEADERS = {"from", "to", "cc", "bcc", "reply-to", "sender"}
+HEADER_READ_SIZE = 65536  # how much of a message to read to get its header
+STREAM_CHUNK_SIZE = 1 << 20  # how much of a compressed mailbox to decompress at a time
+COMPRESSED_MBOX_SUFFIXES = (".gz", ".xz", ".zst")
+JOURNAL_DIR = "./journals"  # default journals, one per destination group, shared by all its imports
+
+MESSAGE_ID_RE = re.compile(rb"^message-id:[ \t]*(.*(?:\r?\n[ \t].*)*)", re.IGNORECASE | re.MULTILINE)
+DATE_RE = re.compile(rb"^date:[ \t]*(.*(?:\r?\n[ \t].*)*)", re.IGNORECASE | re.MULTILINE)
+PLAN_LATENCY = 1.0  # seconds per insert to assume when estimating import duration
+
+
 class Timer:
     """Context manager to measure execution time"""
 
@@ -42,135 +142,1905 @@ class Timer:
         return self.elapsed.__format__(fmt)
 
 
-class RateLimiter:
-    """Helper to rate-limit requests"""
+class MboxIndex:
+    """Persistent index of messages of an mbox mailbox.
+
+    The index file is a header followed by fixed-width records, one per
+    message, holding the byte offset and length of the message within the
+    mailbox, its import status, and a digest of its Message-ID. Records are
+    appended as the mailbox is scanned, and status bytes are updated in place
+    as messages are imported, so an interrupted import can be resumed without
+    re-parsing the mailbox.
+    """
+
+    MAGIC = b"MBOXIDX1"
+    HEADER = struct.Struct("<8sQ?7x")  # magic, mbox size, whether the whole mbox has been indexed
+    RECORD = struct.Struct("<QIB3x16s")  # offset, length, status, Message-ID digest
+    STATUS_OFFSET = 12  # offset of the status byte within a record
+
+    PENDING = 0
+    IMPORTED = 1
+    FAILED = 2
+    DUPLICATE = 3
+    QUARANTINED = 4
+
+    def __init__(self, path):
+        """Open index file under path, creating it if necessary"""
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = os.pread(self.fd, self.HEADER.size, 0)
+        if header:
+            magic, self.mbox_size, self.complete = self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise IndexMismatch(f"{path} is not an mbox index")
+        else:
+            self.mbox_size, self.complete = 0, False
+            self._write_header()
+        # a partially written trailing record is ignored and will be overwritten
+        self.num_records = (os.fstat(self.fd).st_size - self.HEADER.size) // self.RECORD.size
+
+    def __len__(self):
+        return self.num_records
+
+    def _write_header(self):
+        os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.mbox_size, self.complete), 0)
 
-    def __init__(self, max_rate, interval):
-        """Set class parameters"""
-        self.hist = []
-        self.max_rate = max_rate
+    def append(self, offset, length, msgid_digest):
+        """Add a new pending message and return its index"""
+        record = self.RECORD.pack(offset, length, self.PENDING, msgid_digest)
+        os.pwrite(self.fd, record, self.HEADER.size + self.num_records * self.RECORD.size)
+        self.num_records += 1
+        return self.num_records - 1
+
+    def set_status(self, index, status):
+        """Update import status of message number index"""
+        pos = self.HEADER.size + index * self.RECORD.size + self.STATUS_OFFSET
+        os.pwrite(self.fd, bytes((status,)), pos)
+
+    def set_complete(self, mbox_size):
+        """Record that all messages of the first mbox_size bytes of the mailbox are indexed"""
+        self.mbox_size, self.complete = mbox_size, True
+        self._write_header()
+
+    def record(self, index):
+        """Return (offset, length, status, msgid_digest) of message number index"""
+        return self.RECORD.unpack(
+            os.pread(self.fd, self.RECORD.size, self.HEADER.size + index * self.RECORD.size)
+        )
+
+    def message(self, index):
+        """Return MboxMessage of message number index"""
+        offset, length, _, digest = self.record(index)
+        return MboxMessage(index, offset, length, digest)
+
+    def records(self):
+        """Yield (offset, length, status, msgid_digest) of all messages"""
+        if not self.num_records:
+            return
+        with mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ) as mm:
+            end = self.HEADER.size + self.num_records * self.RECORD.size
+            with memoryview(mm)[self.HEADER.size : end] as view:
+                yield from self.RECORD.iter_unpack(view)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConcurrencyController:
+    """Additive-increase/multiplicative-decrease (AIMD) control of the number
+    of messages being imported at the same time.
+
+    The limit grows by about one for every "limit" messages imported without
+    throttling (i.e. by one per round of requests), up to max_limit. It is
+    halved, at most once per round, when a request is throttled (HTTP 503) or
+    when the latency of successful requests rises above latency_tolerance
+    times the baseline latency. Both are exponentially weighted averages of
+    successful latencies, but the baseline is a much slower one, so that an
+    unusually fast response can't pin it, while a lasting change in server
+    responsiveness eventually becomes the new normal. Until there are enough
+    samples, both are plain averages.
+    """
+
+    LATENCY_SMOOTHING = 0.2
+    BASELINE_SMOOTHING = 0.01
+
+    def __init__(self, max_limit, initial_limit=1, latency_tolerance=3.0):
+        self.max_limit = max_limit
+        self.limit = min(initial_limit, max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.num_latencies = 0
+        self.base_latency = 0
+        self.avg_latency = 0
+        self.since_decrease = 0
+
+    def _decrease(self, reason):
+        if self.since_decrease < self.limit or self.limit <= 1:
+            return  # already decreased this round, or can't decrease
+        old_limit = self.limit
+        self.limit = max(1, self.limit / 2)
+        self.since_decrease = 0
+        logging.info(f"concurrency {old_limit:.1f} -> {self.limit:.1f} ({reason})")
+
+    def update(self, attempts):
+        """Adjust the limit based on attempts (list of Attempt) of a processed message"""
+        self.since_decrease += 1
+        if any(a.http_status == 503 for a in attempts):
+            self._decrease("throttled")
+            return
+        latencies = [a.latency for a in attempts if a.response_code == "SUCCESS"]
+        if not latencies:
+            return
+        latency = latencies[-1]
+        self.num_latencies += 1
+        weight = 1 / self.num_latencies
+        self.base_latency += max(weight, self.BASELINE_SMOOTHING) * (latency - self.base_latency)
+        self.avg_latency += max(weight, self.LATENCY_SMOOTHING) * (latency - self.avg_latency)
+        if self.avg_latency > self.latency_tolerance * self.base_latency:
+            self._decrease(f"average latency {self.avg_latency:.2f}s")
+        elif self.limit < self.max_limit:
+            old_limit = self.limit
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            if int(self.limit) > int(old_limit):
+                logging.info(f"concurrency {old_limit:.1f} -> {self.limit:.1f}")
+
+
+class ImportJournal:
+    """SQLite record of the outcome of every import attempt.
+
+    Messages are identified by the path of the source mbox and their index
+    within it (their MboxIndex record number, or the name of the unpacked
+    message file, which is the same). For each message, the journal keeps its
+    Message-ID and dedup key (see read_message_identity()), the destination
+    group, the final state ("imported", "failed", "duplicate" or
+    "quarantined"; once imported, a message stays imported), the outcome of
+    the last attempt, and every attempt is also logged separately. Writes are
+    committed in small batches.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            mbox TEXT NOT NULL,
+            msg_index INTEGER NOT NULL,
+            message_id TEXT,
+            dedup_key BLOB,
+            dst_group TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            http_status INTEGER,
+            response_code TEXT,
+            latency REAL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (mbox, msg_index)
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_state ON messages (mbox, state);
+        CREATE INDEX IF NOT EXISTS messages_by_group ON messages (dst_group, state);
+        CREATE TABLE IF NOT EXISTS attempts (
+            mbox TEXT NOT NULL,
+            msg_index INTEGER NOT NULL,
+            time REAL NOT NULL,
+            http_status INTEGER,
+            response_code TEXT,
+            latency REAL
+        );
+    """
+    COMMIT_INTERVAL = 1  # seconds
+    COMMIT_BATCH = 100
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.uncommitted = 0
+        self.last_commit = monotonic()
+
+    def record(self, mbox, msg_index, message_id, dedup_key, group, state, attempts):
+        """Record final state of a message and its attempts (list of Attempt)"""
+        now = time()
+        last = attempts[-1] if attempts else Attempt(None, None, None)
+        self.db.execute(
+            "INSERT INTO messages (mbox, msg_index, message_id, dedup_key, dst_group, state, attempts, "
+            "http_status, response_code, latency, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (mbox, msg_index) DO UPDATE SET "
+            "message_id=excluded.message_id, dedup_key=excluded.dedup_key, "
+            "dst_group=excluded.dst_group, "
+            "state=CASE WHEN state = 'imported' THEN state ELSE excluded.state END, "
+            "attempts=attempts + excluded.attempts, http_status=excluded.http_status, "
+            "response_code=excluded.response_code, latency=excluded.latency, updated=excluded.updated",
+            (mbox, msg_index, message_id, dedup_key, group, state, len(attempts), *last[:3], now),
+        )
+        self.db.executemany(
+            "INSERT INTO attempts VALUES (?, ?, ?, ?, ?, ?)",
+            [(mbox, msg_index, now, *attempt[:3]) for attempt in attempts],
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_BATCH or monotonic() - self.last_commit >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+        self.last_commit = monotonic()
+
+    def failed(self, mbox):
+        """Return indexes of messages of mbox whose import failed"""
+        rows = self.db.execute(
+            "SELECT msg_index FROM messages WHERE mbox = ? AND state = 'failed' ORDER BY msg_index", (mbox,)
+        )
+        return [msg_index for (msg_index,) in rows]
+
+    def finished(self, mbox):
+        """Return set of indexes of messages of mbox that were imported, or
+        found to be duplicates or unfixable"""
+        rows = self.db.execute("SELECT msg_index FROM messages WHERE mbox = ? AND state != 'failed'", (mbox,))
+        return {msg_index for (msg_index,) in rows}
+
+    def imported_keys(self, group):
+        """Return set of dedup keys of all messages ever imported into group"""
+        rows = self.db.execute(
+            "SELECT dedup_key FROM messages WHERE dst_group = ? AND state = 'imported'", (group,)
+        )
+        return {dedup_key for (dedup_key,) in rows}
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class ImportMetrics:
+    """Throughput and latency statistics of an import, overall and per worker.
+
+    Request latencies are kept in histograms with fixed buckets, from which
+    percentiles are estimated the same way Prometheus' histogram_quantile()
+    does. Rates are computed both over the whole import and since the
+    previous snapshot. Methods may be called from different threads.
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+    QUANTILES = (0.5, 0.95, 0.99)
+    COUNTERS = ("messages", "imported", "failed", "requests", "accepted", "throttled", "retries", "bytes")
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.start = self.last_snapshot_time = monotonic()
+        self.counts = Counter()
+        self.last_snapshot_counts = Counter()
+        self.histograms = defaultdict(lambda: [0] * len(self.LATENCY_BUCKETS))
+        self.latency_sums = Counter()
+        self.progress = None  # optional callable returning fraction of work dispatched
+
+    def record(self, worker_id, success, msg, attempts):
+        """Record result of importing message msg by worker_id"""
+        size = message_size(msg)
+        with self.lock:
+            self.counts["messages"] += 1
+            self.counts["imported" if success else "failed"] += 1
+            self.counts["requests"] += len(attempts)
+            self.counts["retries"] += max(0, len(attempts) - 1)
+            if success:
+                self.counts["bytes"] += size
+            for attempt in attempts:
+                if attempt.response_code == "SUCCESS":
+                    self.counts["accepted"] += 1
+                elif attempt.http_status == 503:
+                    self.counts["throttled"] += 1
+                for histogram_key in (str(worker_id), "all"):
+                    histogram = self.histograms[histogram_key]
+                    histogram[bisect_left(self.LATENCY_BUCKETS, attempt.latency)] += 1
+                    self.latency_sums[histogram_key] += attempt.latency
+
+    def quantile(self, q, histogram):
+        """Estimate q-quantile of latencies in histogram"""
+        rank = q * sum(histogram)
+        cumulative = 0
+        for i, count in enumerate(histogram):
+            if count and cumulative + count >= rank:
+                lower = self.LATENCY_BUCKETS[i - 1] if i else 0
+                upper = self.LATENCY_BUCKETS[i]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return None
+
+    def snapshot(self):
+        """Return current statistics as a JSON-serializable dict"""
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.start
+            interval = now - self.last_snapshot_time
+            counts = dict(self.counts)
+            recent = self.counts - self.last_snapshot_counts
+            self.last_snapshot_time, self.last_snapshot_counts = now, self.counts.copy()
+            latency = {
+                key: {f"p{round(q * 100)}": self.quantile(q, histogram) for q in self.QUANTILES}
+                | {"count": sum(histogram), "sum": self.latency_sums[key]}
+                for key, histogram in sorted(self.histograms.items())
+            }
+            buckets = {key: list(histogram) for key, histogram in self.histograms.items()}
+        progress = self.progress() if self.progress else None
+        return {
+            "time": time(),
+            "labels": self.labels,
+            "elapsed": elapsed,
+            "counts": counts,
+            "accepted_per_sec": recent["accepted"] / interval if interval else 0,
+            "throttled_per_sec": recent["throttled"] / interval if interval else 0,
+            "avg_accepted_per_sec": counts.get("accepted", 0) / elapsed if elapsed else 0,
+            "latency": latency,
+            "latency_buckets": buckets,
+            "progress": progress,
+            "eta": elapsed * (1 - progress) / progress if progress else None,
+        }
+
+    def prometheus(self, snap):
+        """Return snapshot snap in Prometheus text exposition format"""
+
+        def labels(**extra):
+            pairs = self.labels | extra
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs.items()) + "}" if pairs else ""
+
+        name = "mailman_import"
+        lines = []
+        for key in self.COUNTERS:
+            lines.append(f"{name}_{key}_total{labels()} {snap['counts'].get(key, 0)}")
+        lines.append(f"{name}_accepted_per_second{labels()} {snap['accepted_per_sec']}")
+        lines.append(f"{name}_throttled_per_second{labels()} {snap['throttled_per_sec']}")
+        if snap["progress"] is not None:
+            lines.append(f"{name}_progress_ratio{labels()} {snap['progress']}")
+        if snap["eta"] is not None:
+            lines.append(f"{name}_eta_seconds{labels()} {snap['eta']}")
+        latency = f"{name}_request_latency_seconds"
+        lines.append(f"# TYPE {latency} histogram")
+        for worker, histogram in sorted(snap["latency_buckets"].items()):
+            cumulative = 0
+            for bound, count in zip(self.LATENCY_BUCKETS, histogram):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f"{latency}_bucket{labels(worker=worker, le=le)} {cumulative}")
+            lines.append(f"{latency}_sum{labels(worker=worker)} {snap['latency'][worker]['sum']}")
+            lines.append(f"{latency}_count{labels(worker=worker)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsReporter(threading.Thread):
+    """Periodically log progress of an import and export its ImportMetrics
+    snapshots to a Prometheus textfile (if path ends with .prom) or append
+    them to a JSONL file"""
+
+    def __init__(self, metrics, interval, path=None):
+        super().__init__(daemon=True)
+        self.metrics = metrics
         self.interval = interval
+        self.path = path
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
+
+    def report(self):
+        snap = self.metrics.snapshot()
+        counts = snap["counts"]
+        p95 = snap["latency"].get("all", {}).get("p95")
+        logging.info(
+            f"progress: {counts.get('imported', 0)} imported, {counts.get('failed', 0)} failed, "
+            f"{snap['accepted_per_sec']:.1f} accepted/s, {snap['throttled_per_sec']:.1f} throttled/s, "
+            f"{counts.get('retries', 0)} retries, p95 latency "
+            + (f"{p95:.2f}s" if p95 is not None else "n/a")
+            + (f", ETA {snap['eta'] / 60:.0f} min" if snap["eta"] is not None else "")
+        )
+        if not self.path:
+            return
+        if self.path.endswith(".prom"):
+            tmp_path = self.path + ".tmp"  # write atomically for the textfile collector
+            with open(tmp_path, "w") as f:
+                f.write(self.metrics.prometheus(snap))
+            os.replace(tmp_path, self.path)
+        else:
+            del snap["latency_buckets"]
+            with open(self.path, "a") as f:
+                f.write(json.dumps(snap) + "\n")
+
+
+class RequestTimings:
+    """Per-request durations of the phases of insert requests made by a
+    process, for --profile: building the request (including reading the
+    message), waiting for the rate limiter, and executing the request"""
+
+    PHASES = ("prepare", "ratelimit", "execute")
+
+    def __init__(self):
+        self.samples = {phase: [] for phase in self.PHASES}
+
+    def add(self, prepare, ratelimit, execute):
+        self.samples["prepare"].append(prepare)
+        self.samples["ratelimit"].append(ratelimit)
+        self.samples["execute"].append(execute)
+
+    def save(self, path):
+        Path(path).write_text(json.dumps(self.samples))
 
-    def wait_for_clearance(self):
-        """Wait if rate is too high, and then register time of new request"""
-        while len(self.hist) / self.interval >= self.max_rate:
-            now = time()
-            self.hist = [t for t in self.hist if now - t <= self.interval]
-            if self.hist:
-                sleep(min(self.hist) + self.interval - now)
 
-    def register(self):
-        """Register time of new request"""
-        self.hist.append(time())
+@contextmanager
+def profiling(profile_dir, name):
+    """Context manager that profiles the current process with cProfile, if
+    profile_dir is given, and yields RequestTimings (or None) for the code
+    to fill in. On exit, profile_dir/name.prof and profile_dir/name.json
+    receive the profile and the request timings."""
+    if not profile_dir:
+        yield None
+        return
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    timings = RequestTimings()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield timings
+    finally:
+        profiler.disable()
+        profiler.dump_stats(Path(profile_dir) / f"{name}.prof")
+        timings.save(Path(profile_dir) / f"{name}.json")
 
-    def current_rate(self):
-        """Report current rate"""
-        return len(self.hist) / self.interval
 
+def write_profile_summary(profile_dir, top=25):
+    """Write profile_dir/summary.txt summarizing where the manager and worker
+    processes profiled into profile_dir spent their time"""
+    profile_dir = Path(profile_dir)
+    with open(profile_dir / "summary.txt", "w") as f:
+        f.write("Insert request phases per process (seconds; prepare and ratelimit precede execute())\n")
+        f.write(f"{'process':<24} {'requests':>8}" + "".join(f" {p:>10}" for p in RequestTimings.PHASES))
+        f.write(f" {'before execute()':>17}\n")
+        combined = {phase: [] for phase in RequestTimings.PHASES}
+        for path in sorted(profile_dir.glob("*.json")):
+            samples = json.loads(path.read_text())
+            if not samples["execute"]:
+                continue
+            totals = [sum(samples[phase]) for phase in RequestTimings.PHASES]
+            share = (totals[0] + totals[1]) / sum(totals) if sum(totals) else 0
+            f.write(f"{path.stem:<24} {len(samples['execute']):>8}" + "".join(f" {t:>10.2f}" for t in totals))
+            f.write(f" {share:>16.0%}\n")
+            [combined[phase].extend(samples[phase]) for phase in RequestTimings.PHASES]
 
-def worker(work_q, feedback_q, ready_q, backoff_q, group, creds, delegator):
-    """Read file names of an rfc822 email message from "work_q", attempt to
-    insert them into Google group "group", and report result via "feedback_q".
-    Repeat until None is read from "work_q".
+        f.write("\nPer-request phase durations, all processes (milliseconds)\n")
+        columns = ("mean", "p50", "p95", "p99", "max")
+        f.write(f"{'phase':<10}" + "".join(f" {col:>8}" for col in columns) + "\n")
+        for phase, durations in combined.items():
+            if not durations:
+                continue
+            durations.sort()
+            stats = [sum(durations) / len(durations)]
+            stats += [durations[min(len(durations) - 1, int(q * len(durations)))] for q in (0.5, 0.95, 0.99)]
+            stats += [durations[-1]]
+            f.write(f"{phase:<10}" + "".join(f" {d * 1000:>8.1f}" for d in stats) + "\n")
 
-    work_q and feedback_q are used for input and output with the manager process.
+        for role in ("manager", "worker"):
+            prof_paths = sorted(str(path) for path in profile_dir.glob(f"{role}-*.prof"))
+            if not prof_paths:
+                continue
+            f.write(f"\nTop functions of {len(prof_paths)} {role} processes by cumulative time\n")
+            pstats.Stats(*prof_paths, stream=f).strip_dirs().sort_stats("cumulative").print_stats(top)
 
-    ready_q and backoff_q are used for scheduling by the manager process.
+
+def is_retryable(attempt):
+    """Return whether a message is worth another try after failed attempt"""
+    return attempt.http_status == 503 or (attempt.http_status == 200 and attempt.response_code != "SUCCESS")
+
+
+def parse_retry_after(value):
+    """Return number of seconds to wait according to Retry-After header value
+    (delay in seconds or HTTP date), or None if value is None or invalid"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        delay = email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)
+        return max(0.0, delay.total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryQueue:
+    """Messages waiting for another import attempt, ordered by when they are
+    due. A message is due after as long as the server asked for in
+    Retry-After of its last attempt, or otherwise after an exponentially
+    growing delay with full jitter, so that messages throttled at the same
+    time don't come back at the same time."""
+
+    def __init__(self, max_retries=MAX_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.heap = []
+        self.attempts = {}
+        self.counter = itertools.count()  # tie breaker, so messages are never compared
+
+    def __len__(self):
+        return len(self.heap)
+
+    def collect(self, msg, attempts):
+        """Return all attempts to import msg so far, given the latest ones"""
+        return self.attempts.pop(msg, []) + attempts
+
+    def push(self, msg, attempts):
+        """Schedule msg for another attempt if the last of its attempts
+        (list of Attempt) is retryable and retries aren't exhausted. Return
+        whether msg was scheduled."""
+        if not attempts or not is_retryable(attempts[-1]):
+            return False
+        if len(attempts) > self.max_retries:
+            logging.info(f"giving up on {msg} after {len(attempts)} attempts")
+            return False
+        delay = attempts[-1].retry_after
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** len(attempts)))
+        logging.debug(f"retrying {msg} in {delay:.1f}s")
+        self.attempts[msg] = attempts
+        heapq.heappush(self.heap, (monotonic() + delay, next(self.counter), msg))
+        return True
+
+    def next_due(self):
+        """Return monotonic time when the next message is due, or None if empty"""
+        return self.heap[0][0] if self.heap else None
+
+    def pop(self):
+        """Return a message that is due for another attempt, or None"""
+        if self.heap and self.heap[0][0] <= monotonic():
+            return heapq.heappop(self.heap)[2]
+        return None
+
+
+class Dispatcher:
+    """Hand out messages to worker processes and collect the results.
+
+    Each worker has its own work queue and may hold up to "credit" messages
+    at a time. The dispatcher blocks on the shared feedback queue until a
+    worker reports a result, and then immediately refills that worker's credit
+    with pending work. Workers make one attempt per message; messages that
+    need to be retried wait in a RetryQueue, so that their backoff doesn't
+    hold up any worker.
+
+    If a ConcurrencyController is given, the total number of messages held
+    by workers is also kept under its limit. If ImportMetrics are given,
+    results are recorded there.
+
+    Workers are started as target(work_q, feedback_q, worker_id, *args) and
+    must follow the protocol of worker().
+    """
+
+    LIVENESS_CHECK_INTERVAL = 5
+
+    def __init__(self, target, args, num_workers, credit=1, controller=None, metrics=None):
+        self.feedback_q = Queue()
+        self.work_qs = [Queue() for _ in range(num_workers)]
+        self.procs = [
+            Process(target=target, args=(work_q, self.feedback_q, worker_id) + tuple(args))
+            for worker_id, work_q in enumerate(self.work_qs)
+        ]
+        # one entry per unit of available credit, interleaved to spread work evenly
+        self.ready = deque(worker_id for _ in range(credit) for worker_id in range(num_workers))
+        self.pending = deque()
+        self.source = None
+        self.outstanding = 0
+        self.controller = controller
+        self.metrics = metrics
+        self.retry_q = RetryQueue()
+
+    def start(self):
+        [p.start() for p in self.procs]
+
+    def stop(self):
+        [work_q.put(None) for work_q in self.work_qs]
+        [p.join() for p in self.procs]
+
+    def submit(self, msg):
+        """Queue msg for dispatch ahead of messages that haven't been pulled from the source yet"""
+        self.pending.append(msg)
+
+    def _can_dispatch(self):
+        return self.ready and (self.controller is None or self.outstanding < self.controller.limit)
+
+    def _next_msg(self):
+        msg = self.retry_q.pop()
+        if msg is not None:
+            return msg
+        if self.pending:
+            return self.pending.popleft()
+        if self.source is not None:
+            msg = next(self.source, None)
+            if msg is not None:
+                return msg
+            self.source = None
+        return None
+
+    def _wait_for_feedback(self, deadline=None):
+        """Return next report from workers, or None if there is none by
+        deadline (monotonic time)"""
+        while True:
+            timeout = self.LIVENESS_CHECK_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, deadline - monotonic())
+                if timeout <= 0:
+                    return None
+            try:
+                return self.feedback_q.get(timeout=timeout)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.procs):
+                    raise RuntimeError("a worker process exited unexpectedly")
+
+    def run(self, source, on_done):
+        """Dispatch messages from iterable source (and those given to submit())
+        to workers, and call on_done(success, msg, attempts) as results come in. Return
+        the number of processed messages once all of them have been processed."""
+        self.source = iter(source)
+        processed = 0
+        while True:
+            while self._can_dispatch():
+                msg = self._next_msg()
+                if msg is None:
+                    break
+                self.work_qs[self.ready.popleft()].put(msg)
+                self.outstanding += 1
+            next_retry = self.retry_q.next_due()
+            if not self.outstanding:
+                if next_retry is None:
+                    return processed
+                sleep(max(0, next_retry - monotonic()))
+                continue
+            feedback = self._wait_for_feedback(next_retry if self._can_dispatch() else None)
+            if feedback is None:
+                continue  # time to dispatch a retry
+            worker_id, success, msg, attempts = feedback
+            self.outstanding -= 1
+            self.ready.append(worker_id)
+            if self.controller:
+                self.controller.update(attempts)
+            attempts = self.retry_q.collect(msg, attempts)
+            if not success and self.retry_q.push(msg, attempts):
+                continue
+            processed += 1
+            if self.metrics:
+                self.metrics.record(worker_id, success, msg, attempts)
+            on_done(success, msg, attempts)
+
+
+def worker(
+    work_q,
+    feedback_q,
+    worker_id,
+    group,
+    creds,
+    delegator,
+    ratelimiter,
+    mbox_path=None,
+    api_endpoint=None,
+    token_broker=None,
+    profile_dir=None,
+):
+    """Read rfc822 email messages from "work_q", attempt to insert them into
+    Google group "group", and report result via "feedback_q". Repeat until
+    None is read from "work_q".
+
+    A message is either a file name, or an MboxMessage byte range of the
+    mbox mailbox under "mbox_path".
+
+    work_q and feedback_q are used for input and output with the manager
+    process (see Dispatcher). Every message read from work_q is reported back
+    via feedback_q as a (worker_id, success, message, attempts) tuple, where
+    attempts is a list of Attempt tuples describing each request attempt.
+    Only one attempt is made; it's up to the manager to retry (see RetryQueue).
 
     Args:
-        work_q (Queue): source of file names of messages to insert (read-only).
+        work_q (Queue): source of messages to insert (read-only).
         feedback_q (Queue): report whether insertion was successful (write-only).
-        ready_q (Queue): indicate we are waiting to read from work_q (read-write).
-        backoff_q (Queue): indicate we are retrying an insert (read-write).
+        worker_id (int): ID of this worker to include in reports.
         group (str): name of the group where to insert messages.
         creds (str): file name of JSON with service account credentials.
         delegator (str): email address of account to impersonate.
+        ratelimiter (TokenBucketRateLimiter): charged for every request attempt.
+        mbox_path (str): mbox mailbox to read byte ranges from (optional).
+        api_endpoint (str): root URL of the API, if not Google's (optional).
+        token_broker (TokenBroker proxy): source of access tokens for creds
+            and delegator, instead of fetching them directly (optional).
+        profile_dir (str): where to write profile and request timings (optional).
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        creds,
-        scopes=["https://www.googleapis.com/auth/apps.groups.migration"],
-        subject=delegator,
+    with profiling(profile_dir, f"worker-{worker_id}-{os.getpid()}") as timings:
+        insert_messages(
+            work_q,
+            feedback_q,
+            worker_id,
+            group,
+            creds,
+            delegator,
+            ratelimiter,
+            mbox_path,
+            api_endpoint,
+            token_broker,
+            timings,
+        )
+
+
+def insert_messages(
+    work_q,
+    feedback_q,
+    worker_id,
+    group,
+    creds,
+    delegator,
+    ratelimiter,
+    mbox_path,
+    api_endpoint,
+    token_broker,
+    timings,
+):
+    """Body of worker(); timings is RequestTimings to record request phases
+    in, or None"""
+    if token_broker:
+        credentials = brokered_credentials(token_broker, creds, delegator, MIGRATION_SCOPE)
+    else:
+        credentials = service_account.Credentials.from_service_account_file(
+            creds,
+            scopes=[MIGRATION_SCOPE],
+            subject=delegator,
+        )
+    service = discovery.build(
+        "groupsmigration",
+        "v1",
+        credentials=credentials,
+        cache_discovery=False,
+        client_options={"api_endpoint": api_endpoint} if api_endpoint else None,
     )
-    service = discovery.build("groupsmigration", "v1", credentials=credentials, cache_discovery=False)
     archive = service.archive()
     pid = os.getpid()
+    mbox_fd = os.open(mbox_path, os.O_RDONLY) if mbox_path else None
 
     while True:
-        ready_q.put(True)
         msg_file = work_q.get()
-        ready_q.get()
         if msg_file is None:
             return
+        start = perf_counter()
         try:
-            req = archive.insert(groupId=group, media_body=msg_file, media_mime_type="message/rfc822")
-        except MediaUploadSizeError:
-            logging.info(f"{pid} {msg_file} is bigger than maximum allowed size")
-            feedback_q.put((False, msg_file))
+            media_body = MediaInMemoryUpload(load_message(msg_file, mbox_fd), mimetype="message/rfc822")
+            req = archive.insert(groupId=group, media_body=media_body, media_mime_type="message/rfc822")
+            if api_endpoint:
+                # the client only swaps the host of upload URLs, which keep their https scheme
+                scheme = urllib.parse.urlsplit(api_endpoint).scheme
+                req.uri = urllib.parse.urlsplit(req.uri)._replace(scheme=scheme).geturl()
+        except MessageTooBig:
+            logging.info(f"{pid} {msg_file} is bigger than maximum allowed size and can't be shrunk")
+            feedback_q.put((worker_id, False, msg_file, []))
             continue
         except Exception as e:
             logging.info(f"{pid} caught exception while creating request {repr(e)}")
-            feedback_q.put((False, msg_file))
+            feedback_q.put((worker_id, False, msg_file, []))
             continue
 
-        num_retries = 0
-        max_retries = 5
-        while True:
-            sleep(2**num_retries - 1)
-            try:
-                with Timer() as timer:
-                    res = req.execute()
-                    print('.', end='', flush=True)
-            except HttpError as e:
-                logging.info(f"{pid} caught HttpError {repr(e)}")
-                if e.status_code == 503:
-                    perform_retry = True
-                    import_success = False
-                else:
-                    perform_retry = False
-                    import_success = False
-            except Exception as e:
-                logging.info(f"{pid} caught exception while executing request {repr(e)}")
-                perform_retry = False
-                import_success = False
+        prepared = perf_counter()
+        ratelimiter.acquire("groupsmigration")
+        acquired = perf_counter()
+        try:
+            with Timer() as timer:
+                res = req.execute()
+        except HttpError as e:
+            logging.info(f"{pid} caught HttpError {repr(e)}")
+            retry_after = parse_retry_after(e.resp.get("retry-after"))
+            attempt = Attempt(e.status_code, None, timer.elapsed, retry_after)
+        except Exception as e:
+            logging.info(f"{pid} caught exception while executing request {repr(e)}")
+            attempt = Attempt(None, None, timer.elapsed)
+        else:
+            attempt = Attempt(200, res["responseCode"], timer.elapsed)
+            if res["responseCode"] == "SUCCESS":
+                logging.debug(f"{pid} inserted {msg_file} in {timer:.2f}s")
             else:
-                if res["responseCode"] == "SUCCESS":
-                    logging.debug(f"{pid} inserted {msg_file} in {timer:.2f}s {num_retries} retries")
-                    perform_retry = False
-                    import_success = True
-                else:
-                    logging.info(f"{pid} failed to insert {msg_file} {res}")
-                    perform_retry = True
-                    import_success = False
-
-            if perform_retry:
-                num_retries += 1
-                if num_retries == 1:
-                    backoff_q.put(True)
-                if num_retries <= max_retries:
-                    continue
-                else:
-                    logging.info(f"{pid} giving up on {msg_file} after {num_retries} attempts")
-                    backoff_q.get()
-                    feedback_q.put((import_success, msg_file))
+                logging.info(f"{pid} failed to insert {msg_file} {res}")
+        if timings:
+            timings.add(prepared - start, acquired - prepared, timer.elapsed)
+        feedback_q.put((worker_id, attempt.response_code == "SUCCESS", msg_file, [attempt]))
+
+
+class TokenBroker:
+    """Cache of access tokens of service account credentials, so that all
+    worker processes share tokens instead of each loading credentials and
+    going through domain-wide delegation on its own. Meant to be served to
+    workers by a TokenBrokerManager (see brokered_credentials())."""
+
+    # must exceed how long before expiry google.auth credentials refresh tokens
+    EXPIRY_MARGIN = timedelta(minutes=5)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.credentials = {}
+
+    def get_token(self, creds, delegator, scope):
+        """Return (access token, expiry) for service account credentials in
+        JSON file creds impersonating delegator with scope. Expiry is a
+        naive datetime in UTC, like google.auth uses."""
+        with self.lock:
+            key = (creds, delegator, scope)
+            if key not in self.credentials:
+                self.credentials[key] = service_account.Credentials.from_service_account_file(
+                    creds, scopes=[scope], subject=delegator
+                )
+            credentials = self.credentials[key]
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            if not credentials.token or credentials.expiry - self.EXPIRY_MARGIN < now:
+                credentials.refresh(Request())
+                logging.debug(f"refreshed token for {delegator} {scope}, expires {credentials.expiry}")
+            return credentials.token, credentials.expiry
+
+
+class TokenBrokerManager(BaseManager):
+    pass
+
+
+TokenBrokerManager.register("TokenBroker", TokenBroker)
+
+
+def brokered_credentials(token_broker, creds, delegator, scope):
+    """Return google.auth credentials that get their tokens from token_broker
+    (TokenBroker proxy)"""
+    return google.oauth2.credentials.Credentials(
+        token=None,
+        scopes=[scope],
+        refresh_handler=lambda request, scopes: token_broker.get_token(creds, delegator, scope),
+    )
+
+
+class AsyncAccessToken:
+    """Access token of service account credentials for use by coroutines,
+    refreshed in a background thread when necessary"""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.lock = asyncio.Lock()
+
+    async def get(self):
+        async with self.lock:
+            if not self.credentials.valid:
+                await asyncio.get_running_loop().run_in_executor(None, self.credentials.refresh, Request())
+        return self.credentials.token
+
+
+async def async_insert(session, token, ratelimiter, url, msg, msg_bytes, timings=None, prepare_time=0):
+    """Make one attempt to insert rfc822 message msg_bytes into a Google group
+    by uploading it to the group's archive media upload url using aiohttp
+    session, like worker() does. Return Attempt. If timings (RequestTimings)
+    are given, record the request there, with prepare_time spent loading
+    the message."""
+    start = perf_counter()
+    await ratelimiter.acquire_async("groupsmigration")
+    acquired = perf_counter()
+    try:
+        # like execute() of googleapiclient requests, this includes refreshing the token if needed
+        with Timer() as timer:
+            headers = {"Authorization": f"Bearer {await token.get()}", "Content-Type": "message/rfc822"}
+            async with session.post(
+                url, params={"uploadType": "media"}, data=msg_bytes, headers=headers
+            ) as resp:
+                status = resp.status
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                res = await resp.json(content_type=None) if status == 200 else await resp.text()
+    except Exception as e:
+        if timings:
+            timings.add(prepare_time, acquired - start, timer.elapsed)
+        logging.info(f"caught exception while executing request for {msg} {repr(e)}")
+        return Attempt(None, None, timer.elapsed)
+
+    if timings:
+        timings.add(prepare_time, acquired - start, timer.elapsed)
+    if status != 200:
+        logging.info(f"HTTP {status} while inserting {msg} {res}")
+        return Attempt(status, None, timer.elapsed, retry_after)
+    if res["responseCode"] == "SUCCESS":
+        logging.debug(f"inserted {msg} in {timer:.2f}s")
+    else:
+        logging.info(f"failed to insert {msg} {res}")
+    return Attempt(status, res["responseCode"], timer.elapsed)
+
+
+async def import_messages_async(
+    source,
+    on_done,
+    group,
+    credentials,
+    ratelimiter,
+    concurrency,
+    mbox_path=None,
+    controller=None,
+    metrics=None,
+    api_endpoint=MIGRATION_API_ENDPOINT,
+    timings=None,
+):
+    """Insert messages from iterable source into Google group "group" from a
+    single event loop, with up to "concurrency" requests in flight over a pool
+    of keep-alive connections. This is an alternative to Dispatcher and
+    worker processes, and reports results the same way, via on_done(success,
+    msg, attempts). Return the number of processed messages. If timings
+    (RequestTimings) are given, phases of every request are recorded there."""
+    import aiohttp  # only needed for this engine
+
+    url = api_endpoint.rstrip("/") + "/" + MIGRATION_UPLOAD_PATH.format(group=group)
+    token = AsyncAccessToken(credentials)
+    mbox_fd = os.open(mbox_path, os.O_RDONLY) if mbox_path else None
+    in_flight = set()
+    retry_q = RetryQueue()
+    processed = 0
+
+    async def insert(msg):
+        try:
+            with Timer() as load_timer:
+                msg_bytes = load_message(msg, mbox_fd)
+        except MessageTooBig:
+            logging.info(f"{msg} is bigger than maximum allowed size and can't be shrunk")
+            return False, msg, []
+        except Exception as e:
+            logging.info(f"caught exception while loading {msg} {repr(e)}")
+            return False, msg, []
+        attempt = await async_insert(
+            session, token, ratelimiter, url, msg, msg_bytes, timings, load_timer.elapsed
+        )
+        return attempt.response_code == "SUCCESS", msg, [attempt]
+
+    async def wait_for_results(timeout):
+        nonlocal in_flight, processed
+        done, in_flight = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            success, msg, attempts = task.result()
+            if controller:
+                controller.update(attempts)
+            attempts = retry_q.collect(msg, attempts)
+            if not success and retry_q.push(msg, attempts):
+                continue
+            processed += 1
+            if metrics:
+                metrics.record(0, success, msg, attempts)
+            on_done(success, msg, attempts)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=300)
+    source = iter(source)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        while True:
+            while len(in_flight) < (controller.limit if controller else concurrency):
+                msg = retry_q.pop()
+                if msg is None and source is not None:
+                    msg = next(source, None)
+                    if msg is None:
+                        source = None
+                if msg is None:
                     break
+                in_flight.add(asyncio.create_task(insert(msg)))
+            next_retry = retry_q.next_due()
+            retry_wait = None if next_retry is None else max(0, next_retry - monotonic())
+            if in_flight:
+                await wait_for_results(retry_wait)
+            elif retry_wait is not None:
+                await asyncio.sleep(retry_wait)
             else:
-                if num_retries:
-                    backoff_q.get()
-                feedback_q.put((import_success, msg_file))
                 break
+    if mbox_fd is not None:
+        os.close(mbox_fd)
+    return processed
+
+
+def iter_mbox_messages(buf, from_pos=None, end=None):
+    """Yield (offset, length) byte ranges of messages in mbox data "buf" as they
+    are found. "buf" can be bytes or a memory map. If given, from_pos must be
+    the position of a "From " line where to start, and end the position of a
+    "From " line (or end of data) where to stop.
+
+    The ranges are the same as what mailbox.mbox's get_bytes() returns: the
+    "From " line is excluded, and so is the empty line that separates messages.
+    Like mailbox.mbox, only lines that begin with "From " are separators, so
+    mboxrd/mboxo-escaped ">From " lines are left alone as part of the message.
+    """
+    size = len(buf) if end is None else end
+    if from_pos is None:
+        if buf[:5] == b"From ":
+            from_pos = 0
+        else:
+            from_pos = buf.find(b"\nFrom ", 0, size) + 1
+            if not from_pos:
+                return
+    while True:
+        start = buf.find(b"\n", from_pos, size) + 1 or size
+        next_from = buf.find(b"\nFrom ", start - 1, size)
+        if next_from == -1:
+            # an empty last line is the separator that precedes end of file
+            if start <= size - 1 and buf[size - 2 : size] == b"\n\n":
+                yield start, size - 1 - start
+            else:
+                yield start, size - start
+            return
+        # an empty line right before the next "From " line is a separator
+        if next_from >= start and buf[next_from - 1 : next_from] == b"\n":
+            yield start, next_from - start
+        else:
+            yield start, next_from + 1 - start
+        from_pos = next_from + 1
+
 
+def scan_mbox_chunk(mbox_path, from_pos, end):
+    """Return list of (offset, length) byte ranges of messages in chunk of
+    mbox mailbox mbox_path that starts at from_pos and ends at end (see
+    iter_mbox_messages())"""
+    with open(mbox_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return list(iter_mbox_messages(mm, from_pos, end))
 
-def unpack_mbox(mbox_path, workdir_path):
-    """Save all messages in mbox mailbox under mbox_path as separate file in workdir_path"""
+
+def write_mbox_messages(mbox_path, workdir_path, first_key, ranges):
+    """Save messages at byte ranges of mbox mailbox mbox_path as separate files
+    in workdir_path, named by consecutive keys starting with first_key"""
+    workdir = Path(workdir_path)
+    with open(mbox_path, "rb") as f:
+        for key, (offset, length) in enumerate(ranges, first_key):
+            (workdir / str(key)).write_bytes(os.pread(f.fileno(), length, offset))
+
+
+def split_mbox_parallel(mbox_path, num_procs):
+    """Return list of (offset, length) byte ranges of messages in mbox mailbox
+    mbox_path, the same as iter_mbox_messages() would, using num_procs
+    processes. The mailbox is cut into chunks at "From " lines, which are
+    then scanned concurrently."""
+    size = os.path.getsize(mbox_path)
+    if not size:
+        return []
+    num_chunks = num_procs * 4  # for load balancing
+    with open(mbox_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        cuts = {mm.find(b"\nFrom ", size * i // num_chunks) + 1 for i in range(1, num_chunks)}
+    cuts = sorted(cuts - {0})
+    chunks = [(mbox_path, None, cuts[0] if cuts else size)]
+    chunks += [(mbox_path, start, end) for start, end in zip(cuts, cuts[1:] + [size])]
+    with multiprocessing.Pool(num_procs) as pool:
+        return [r for chunk_ranges in pool.starmap(scan_mbox_chunk, chunks) for r in chunk_ranges]
+
+
+def iter_mbox_stream(f, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield contents of messages of mbox data read sequentially from binary
+    file object f, as they are found. Unlike iter_mbox_messages(), this
+    doesn't need the whole mailbox to be accessible at once, only the message
+    being read. Messages are the same as what mailbox.mbox's get_bytes()
+    returns."""
+    buf = bytearray()
+    while chunk := f.read(chunk_size):
+        search_from = max(0, len(buf) - 5)
+        buf += chunk
+        # everything before the last "From " line found so far is complete
+        cut = buf.rfind(b"\nFrom ", search_from)
+        if cut == -1:
+            continue
+        complete = bytes(buf[: cut + 1])
+        del buf[: cut + 1]
+        for offset, length in iter_mbox_messages(complete):
+            yield complete[offset : offset + length]
+    complete = bytes(buf)
+    for offset, length in iter_mbox_messages(complete):
+        yield complete[offset : offset + length]
+
+
+def open_compressed_mbox(mbox_path):
+    """Return binary file object for reading decompressed data of mbox_path
+    compressed with gzip, xz or zstd (based on file name extension), or None
+    if mbox_path isn't compressed"""
+    suffix = Path(mbox_path).suffix
+    if suffix == ".gz":
+        return gzip.open(mbox_path, "rb")
+    if suffix == ".xz":
+        return lzma.open(mbox_path, "rb")
+    if suffix == ".zst":
+        import zstandard  # only needed for zstd-compressed archives
+
+        return zstandard.ZstdDecompressor().stream_reader(open(mbox_path, "rb"), closefd=True)
+    return None
+
+
+def get_message_id(buf, offset=0, length=None):
+    """Return Message-ID of message at offset of length in buf (bytes or a
+    memory map; by default, all of it), or None if it doesn't have one"""
+    end = len(buf) if length is None else offset + length
+    header_end = buf.find(b"\n\n", offset, end)
+    match = MESSAGE_ID_RE.search(buf, offset, end if header_end == -1 else header_end + 1)
+    if not match or not match.group(1).strip():
+        return None
+    return b"".join(match.group(1).split())
+
+
+def get_message_id_digest(buf, offset, length):
+    """Return digest of Message-ID of message at offset of length in buf, or
+    zero bytes if the message doesn't have a Message-ID"""
+    msgid = get_message_id(buf, offset, length)
+    if msgid is None:
+        return NO_MESSAGE_ID
+    return hashlib.blake2b(msgid, digest_size=16).digest()
+
+
+def read_message(msg, mbox_fd=None, limit=None):
+    """Return content of message msg (file name, StreamedMessage, or
+    MboxMessage of mbox open as mbox_fd), or only up to its first limit bytes"""
+    if isinstance(msg, StreamedMessage):
+        return msg.content[:limit]
+    if isinstance(msg, MboxMessage):
+        return os.pread(mbox_fd, msg.length if limit is None else min(msg.length, limit), msg.offset)
+    with open(msg, "rb") as f:
+        return f.read(limit)
+
+
+def message_index(msg):
+    """Return index of message msg (file name, MboxMessage or StreamedMessage)
+    in its mailbox"""
+    return int(Path(msg).name) if isinstance(msg, str) else msg.index
+
+
+def read_message_identity(msg, mbox_fd=None):
+    """Return (Message-ID, dedup key) of message msg (file name, or
+    MboxMessage of mbox open as mbox_fd). Message-ID is a string, or None if
+    the message doesn't have one. Dedup key identifies the message for the
+    purpose of deduplication: it's the digest of the Message-ID, or of the
+    whole message if it doesn't have a Message-ID."""
+    header = read_message(msg, mbox_fd, HEADER_READ_SIZE)
+    msgid = get_message_id(header)
+    if msgid is not None:
+        return msgid.decode(errors="replace"), b"i" + hashlib.blake2b(msgid, digest_size=16).digest()
+    content = header if len(header) < HEADER_READ_SIZE else read_message(msg, mbox_fd)
+    return None, b"c" + hashlib.blake2b(content, digest_size=16).digest()
+
+
+def read_message_headers(msg, mbox_fd=None):
+    """Return header of message msg (file name, or MboxMessage of mbox open as
+    mbox_fd) parsed into an email.message.Message, without reading the body"""
+    header = read_message(msg, mbox_fd, HEADER_READ_SIZE)
+    header_end = header.find(b"\n\n")
+    if header_end != -1:
+        header = header[: header_end + 1]
+    return email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(header)
+
+
+def message_date(headers):
+    """Return Date of message with headers (email.message.Message) as an aware
+    datetime (UTC if the header has no time zone), or None if it's missing
+    or can't be parsed"""
+    try:
+        date = email.utils.parsedate_to_datetime(str(headers["Date"]))
+    except (TypeError, ValueError, IndexError):
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def load_priority_function(spec):
+    """Return function named by spec of the form "module:function" """
+    module_name, _, func_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def schedule_messages(msgs, mbox_fd, recent_months=None, priority=None):
+    """Return list of messages from iterable msgs (file names, or MboxMessage
+    of mbox open as mbox_fd) in the order they should be imported.
+
+    Only message headers are read. If priority function is given, it is
+    called with headers of each message (email.message.Message) and messages
+    are sorted by the returned keys, lowest first. Otherwise, messages are
+    sorted by Date, newest first. If recent_months is given, only messages
+    from that many recent months are moved forward this way, followed by the
+    rest in their original order. Messages without a valid Date count as
+    the oldest.
+    """
+    if priority is None:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=30.44 * recent_months) if recent_months else None
+
+        def priority(headers):
+            date = message_date(headers)
+            if date is None or (cutoff and date < cutoff):
+                return (1, 0)  # sort is stable, so these keep their order
+            return (0, -date.timestamp())
+
+    with Timer() as timer:
+        scheduled = sorted(msgs, key=lambda msg: priority(read_message_headers(msg, mbox_fd)))
+    logging.info(f"scheduled {len(scheduled)} messages in {timer.elapsed:.1f}s")
+    return scheduled
+
+
+def message_size(msg):
+    """Return size of message msg (file name, MboxMessage or StreamedMessage)"""
+    if isinstance(msg, StreamedMessage):
+        return len(msg.content)
+    return msg.length if isinstance(msg, MboxMessage) else os.path.getsize(msg)
+
+
+def shrink_message(msg_bytes, max_size):
+    """Return rfc822 message msg_bytes shrunk to at most max_size bytes by
+    replacing its biggest non-multipart parts, attachments first, with short
+    text placeholders. Raise MessageTooBig if that's not enough."""
+    policy = email.policy.compat32.clone(mangle_from_=False)
+    msg = email.message_from_bytes(msg_bytes, policy=policy)
+    parts = [part for part in msg.walk() if not part.is_multipart()]
+
+    def removal_order(part):
+        is_attachment = (
+            part.get_content_disposition() == "attachment" or part.get_content_maintype() != "text"
+        )
+        return is_attachment, len(part.get_payload())
+
+    for part in sorted(parts, key=removal_order, reverse=True):
+        filename = part.get_filename()
+        placeholder = SHRINK_PLACEHOLDER.format(
+            content_type=part.get_content_type(),
+            filename=f' "{filename}"' if filename else "",
+            size=len(part.get_payload(decode=True)),
+        )
+        for header in ("Content-Type", "Content-Transfer-Encoding", "Content-Disposition"):
+            del part[header]
+        part["Content-Type"] = 'text/plain; charset="utf-8"'
+        part["Content-Transfer-Encoding"] = "8bit"
+        part.set_payload(placeholder.encode(), "utf-8")
+        out = io.BytesIO()
+        email.generator.BytesGenerator(out, policy=policy).flatten(msg)
+        if out.tell() <= max_size:
+            return out.getvalue()
+    raise MessageTooBig
+
+
+def decode_header_bytes(value):
+    """Return text of raw header value (str with undecodable bytes escaped as
+    surrogates), guessing its charset"""
+    raw = value.encode("ascii", "surrogateescape")
+    for charset in ("utf-8", "cp1252"):
+        try:
+            return raw.decode(charset)
+        except UnicodeDecodeError:
+            pass
+    return raw.decode("latin-1")
+
+
+def encode_header_value(name, value):
+    """Return raw header value of header name with 8-bit characters encoded
+    as RFC 2047 encoded words, leaving email addresses intact"""
+    text = " ".join(decode_header_bytes(value).split())
+    if name.lower() in ADDRESS_HEADERS:
+        addresses = email.utils.getaddresses([text])
+        return ", ".join(email.utils.formataddr(address, charset="utf-8") for address in addresses)
+    return email.header.Header(text, "utf-8").encode()
+
+
+def normalize_message(msg_bytes):
+    """Return (normalized msg_bytes, list of repairs) for rfc822 message
+    msg_bytes, repaired so that the Groups Migration API accepts it.
+
+    Line endings are normalized to LF. Header values with raw 8-bit bytes are
+    RFC 2047-encoded. A missing Message-ID is replaced with one derived from
+    the message content, so it's the same every time. A missing header/body
+    separator is added, and multipart parts without usable boundaries are
+    relabeled text/plain. Messages that need no repairs are returned as they
+    are, except for line endings. Raise MessageUnfixable if the message has
+    no headers or no From header.
+    """
+    line_repairs = ["line endings"] if b"\r" in msg_bytes else []
+    msg_bytes = msg_bytes.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    policy = email.policy.compat32.clone(mangle_from_=False)
+    msg = email.message_from_bytes(msg_bytes, policy=policy)
+    if not msg.keys():
+        raise MessageUnfixable("no headers")
+    if msg["From"] is None:
+        raise MessageUnfixable("no From header")
+
+    repairs = []
+    if any(isinstance(d, email.errors.MissingHeaderBodySeparatorDefect) for d in msg.defects):
+        repairs.append("header/body separator")
+    raw_items = list(msg.raw_items())
+    if any(not value.isascii() for _, value in raw_items):
+        for name in {name for name, _ in raw_items}:
+            del msg[name]
+        for name, value in raw_items:
+            msg[name] = value if value.isascii() else encode_header_value(name, value)
+        repairs.append("header encoding")
+    if not (msg["Message-ID"] or "").strip():
+        digest = hashlib.blake2b(msg_bytes, digest_size=16).hexdigest()
+        del msg["Message-ID"]
+        msg["Message-ID"] = f"<{digest}@{SYNTHETIC_MSGID_DOMAIN}>"
+        repairs.append("Message-ID")
+    for part in msg.walk():
+        if part.get_content_maintype() == "multipart" and not part.is_multipart():
+            part.set_type("text/plain")
+            part.del_param("boundary")
+            repairs.append("MIME structure")
+
+    if not repairs:
+        return msg_bytes, line_repairs
+    out = io.BytesIO()
+    email.generator.BytesGenerator(out, policy=policy).flatten(msg)
+    return out.getvalue(), repairs + line_repairs
+
+
+def init_normalization_process(mbox_path):
+    """Initialize normalization pool process for messages of mbox_path"""
+    global normalization_mbox_fd
+    normalization_mbox_fd = os.open(mbox_path, os.O_RDONLY) if mbox_path else None
+
+
+def normalize_message_task(msg, repaired_dir):
+    """Normalize message msg (file name, StreamedMessage, or MboxMessage of the
+    mbox opened by init_normalization_process()) with normalize_message(). If
+    it needed repairs, the message file is overwritten, a StreamedMessage is
+    replaced, or, for an MboxMessage, the repaired message is saved in
+    repaired_dir under its index. Return (msg to import, repairs, reason why
+    it couldn't be fixed or None)."""
+    msg_bytes = read_message(msg, normalization_mbox_fd)
+    try:
+        normalized, repairs = normalize_message(msg_bytes)
+    except MessageUnfixable as e:
+        return msg, [], str(e)
+    if not repairs:
+        return msg, repairs, None
+    if isinstance(msg, StreamedMessage):
+        return msg._replace(content=normalized), repairs, None
+    if isinstance(msg, MboxMessage):
+        repaired_path = Path(repaired_dir) / str(msg.index)
+        repaired_path.parent.mkdir(exist_ok=True)
+        repaired_path.write_bytes(normalized)
+        return str(repaired_path), repairs, None
+    Path(msg).write_bytes(normalized)
+    return msg, repairs, None
+
+
+def normalize_messages(msgs, mbox_path, repaired_dir, num_procs, on_unfixable):
+    """Yield messages from iterable msgs normalized by normalize_message_task()
+    in a pool of num_procs processes. Messages that can't be fixed are passed
+    to on_unfixable(msg, reason) instead. msgs is consumed in batches by the
+    calling thread."""
+    msgs = iter(msgs)  # may be a list, e.g. from schedule_messages()
+    batch_size = num_procs * 64
+    with multiprocessing.Pool(num_procs, init_normalization_process, (mbox_path,)) as pool:
+        while batch := list(itertools.islice(msgs, batch_size)):
+            tasks = [(msg, repaired_dir) for msg in batch]
+            for (msg, _), (normalized_msg, repairs, error) in zip(
+                tasks, pool.starmap(normalize_message_task, tasks, chunksize=16)
+            ):
+                if error:
+                    on_unfixable(msg, error)
+                    continue
+                if repairs:
+                    logging.debug(f"repaired {msg}: {', '.join(repairs)}")
+                yield normalized_msg
+
+
+def load_message(msg, mbox_fd=None):
+    """Return content of message msg (file name, or MboxMessage of mbox open
+    as mbox_fd), shrunk with shrink_message() if it's too big to import"""
+    msg_bytes = read_message(msg, mbox_fd)
+    if len(msg_bytes) <= MAX_MESSAGE_SIZE:
+        return msg_bytes
+    shrunk = shrink_message(msg_bytes, MAX_MESSAGE_SIZE)
+    logging.info(f"shrunk {msg} from {len(msg_bytes)} to {len(shrunk)} bytes")
+    return shrunk
+
+
+def dedup_messages(msgs, seen, mbox_fd, on_duplicate):
+    """Yield messages from msgs whose dedup key (see read_message_identity())
+    isn't in set "seen", adding keys to "seen" as it goes, and call
+    on_duplicate(msg) for the rest. Only message headers are read, except for
+    messages without a Message-ID, and MboxMessages with a Message-ID digest
+    aren't read at all."""
+    for msg in msgs:
+        if isinstance(msg, MboxMessage) and msg.digest != NO_MESSAGE_ID:
+            key = b"i" + msg.digest
+        else:
+            _, key = read_message_identity(msg, mbox_fd)
+        if key in seen:
+            on_duplicate(msg)
+        else:
+            seen.add(key)
+            yield msg
+
+
+def stream_mbox(mbox_path, index):
+    """Yield not yet imported messages of mbox mailbox under mbox_path as
+    MboxMessage byte ranges, without unpacking them.
+
+    Messages already in MboxIndex "index" are yielded first. Then the rest of
+    the mailbox is memory-mapped and scanned incrementally, and new messages
+    are added to the index as they are found.
+    """
+    for i, (offset, length, status, digest) in enumerate(index.records()):
+        if status in (MboxIndex.PENDING, MboxIndex.FAILED):
+            yield MboxMessage(i, offset, length, digest)
+
+    with open(mbox_path, "rb") as f:
+        mbox_size = os.fstat(f.fileno()).st_size
+        if mbox_size < index.mbox_size:
+            raise IndexMismatch(f"{mbox_path} is smaller than when it was indexed")
+        if index.complete and mbox_size == index.mbox_size:
+            return
+        if not mbox_size:
+            index.set_complete(mbox_size)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if index.num_records:
+                # continue after the last indexed message
+                last_offset, last_length, _, _ = index.record(index.num_records - 1)
+                from_pos = mm.find(b"\nFrom ", last_offset + last_length - 1) + 1
+            else:
+                from_pos = None
+            if from_pos != 0:
+                for offset, length in iter_mbox_messages(mm, from_pos):
+                    digest = get_message_id_digest(mm, offset, length)
+                    i = index.append(offset, length, digest)
+                    yield MboxMessage(i, offset, length, digest)
+    index.set_complete(mbox_size)
+
+
+def stream_compressed_mbox(mbox_path, wanted=None):
+    """Yield messages of compressed mbox mailbox under mbox_path as they are
+    decompressed, as StreamedMessages, without unpacking them to disk. If
+    given, only messages whose index is accepted by function wanted are
+    yielded."""
+    with open_compressed_mbox(mbox_path) as f:
+        for i, msg_bytes in enumerate(iter_mbox_stream(f)):
+            if wanted is None or wanted(i):
+                yield StreamedMessage(i, msg_bytes)
+
+
+def unpack_mbox(mbox_path, workdir_path, num_procs=1, leftovers=()):
+    """Save all messages in mbox mailbox under mbox_path as separate file in
+    workdir_path, using num_procs processes. Compressed mailboxes are
+    decompressed on the fly (in a single process). Raise
+    WorkingDirectoryNotEmpty if workdir_path holds anything but leftovers
+    (file names)."""
     workdir = Path(workdir_path)
     workdir.mkdir(exist_ok=True)
-    if list(workdir.iterdir()):
+    if any(f.name not in leftovers for f in workdir.iterdir()):
         raise WorkingDirectoryNotEmpty
 
-    mbox = mailbox.mbox(mbox_path)
-    for key in mbox.iterkeys():
-        msg_file = workdir / str(key)
-        msg_file.write_bytes(mbox.get_bytes(key))
+    compressed = open_compressed_mbox(mbox_path)
+    if compressed:
+        with compressed:
+            for key, msg_bytes in enumerate(iter_mbox_stream(compressed)):
+                (workdir / str(key)).write_bytes(msg_bytes)
+        return
+
+    with Timer() as timer:
+        ranges = split_mbox_parallel(mbox_path, num_procs)
+        batch_size = len(ranges) // (num_procs * 4) + 1
+        batches = [
+            (mbox_path, workdir_path, first_key, ranges[first_key : first_key + batch_size])
+            for first_key in range(0, len(ranges), batch_size)
+        ]
+        with multiprocessing.Pool(num_procs) as pool:
+            pool.starmap(write_mbox_messages, batches)
+    logging.info(f"unpacked {len(ranges)} messages using {num_procs} processes in {timer.elapsed:.1f}s")
+
+
+def run_engine(args, msgs, on_done, ratelimiter, metrics=None, token_broker=None, timings=None):
+    """Import messages from iterable msgs using the engine selected by
+    command line arguments args. Return the number of processed messages.
+    Timings (RequestTimings) are only recorded by the asyncio engine, whose
+    requests are made by this process."""
+    compressed = Path(args.src_mbox).suffix in COMPRESSED_MBOX_SUFFIXES
+    mbox_path = args.src_mbox if args.stream and not compressed else None
+    if args.engine == "asyncio":
+        controller = ConcurrencyController(args.num_workers) if args.adaptive else None
+        if token_broker:
+            credentials = brokered_credentials(
+                token_broker, args.sa_creds, args.sa_delegator, MIGRATION_SCOPE
+            )
+        else:
+            credentials = service_account.Credentials.from_service_account_file(
+                args.sa_creds, scopes=[MIGRATION_SCOPE], subject=args.sa_delegator
+            )
+        return asyncio.run(
+            import_messages_async(
+                msgs,
+                on_done,
+                args.dst_group,
+                credentials,
+                ratelimiter,
+                args.num_workers,
+                mbox_path,
+                controller,
+                metrics,
+                args.api_endpoint,
+                timings,
+            )
+        )
+
+    controller = ConcurrencyController(args.num_workers * args.worker_credit) if args.adaptive else None
+    worker_args = (
+        args.dst_group,
+        args.sa_creds,
+        args.sa_delegator,
+        ratelimiter,
+        mbox_path,
+        args.api_endpoint,
+        token_broker,
+        args.profile,
+    )
+    dispatcher = Dispatcher(worker, worker_args, args.num_workers, args.worker_credit, controller, metrics)
+    dispatcher.start()
+    try:
+        return dispatcher.run(msgs, on_done)
+    finally:
+        dispatcher.stop()
+
+
+def import_archive(args, ratelimiter, token_broker=None, timings=None):
+    """Import mbox args.src_mbox into group args.dst_group as configured by
+    command line arguments args, sharing rate budgets of ratelimiter and
+    access tokens of token_broker. Raise ImportAborted if the import can't
+    be started. Timings are passed on to run_engine()."""
+    if args.replay_failed:
+        args.resume = True
+    workdir = Path(args.work_dir)
+    mbox_key = str(Path(args.src_mbox).resolve())
+    journal_path = Path(args.journal or Path(JOURNAL_DIR) / f"{args.dst_group}.sqlite")
+    journal_path.parent.mkdir(parents=True, exist_ok=True)
+    # what a finished import leaves behind doesn't need --resume
+    leftovers = {"quarantine", "repaired"}
+    if journal_path.resolve().parent == workdir.resolve():
+        leftovers.add(journal_path.name)
+    compressed = Path(args.src_mbox).suffix in COMPRESSED_MBOX_SUFFIXES
+    index = None
+    mbox_fd = None
+    if args.stream and compressed:
+        pass  # there's nothing to index, the journal tells which messages are finished
+    elif args.stream:
+        workdir.mkdir(exist_ok=True)
+        if not args.resume and any(f.name not in leftovers for f in workdir.iterdir()):
+            raise ImportAborted("working directory is not empty but --resume not given")
+        try:
+            index = MboxIndex(workdir / "mbox.idx")
+        except IndexMismatch as e:
+            raise ImportAborted(e)
+        if os.path.getsize(args.src_mbox) < index.mbox_size:
+            raise ImportAborted(f"{args.src_mbox} has changed since it was indexed")
+        if args.resume:
+            logging.info(f"resuming with {len(index)} messages in index {index.path}")
+        mbox_fd = os.open(args.src_mbox, os.O_RDONLY)
+    else:
+        if args.resume:
+            logging.info("ignoring --src-mbox because --resume is specified")
+        else:
+            try:
+                unpack_mbox(args.src_mbox, args.work_dir, args.unpack_procs, leftovers)
+            except WorkingDirectoryNotEmpty:
+                raise ImportAborted("working directory is not empty but --resume not given")
+    journal = ImportJournal(journal_path)
+
+    if args.stream and compressed:
+        if args.replay_failed:
+            failed = set(journal.failed(mbox_key))
+            total_msgs = len(failed)
+            logging.info(f"replaying {len(failed)} failed messages")
+            msgs = stream_compressed_mbox(args.src_mbox, failed.__contains__)
+        elif args.resume:
+            finished = journal.finished(mbox_key)
+            total_msgs = None
+            logging.info(f"resuming after {len(finished)} finished messages in journal")
+            msgs = stream_compressed_mbox(args.src_mbox, lambda i: i not in finished)
+        else:
+            total_msgs = None
+            msgs = stream_compressed_mbox(args.src_mbox)
+        logging.info(f"streaming messages from {args.src_mbox}")
+    elif args.replay_failed:
+        failed = journal.failed(mbox_key)
+        total_msgs = len(failed)
+        logging.info(f"replaying {len(failed)} failed messages")
+        if args.stream:
+            msgs = (index.message(i) for i in failed)
+        else:
+            msgs = (str(workdir / str(i)) for i in failed if (workdir / str(i)).exists())
+    elif args.stream:
+        msgs = stream_mbox(args.src_mbox, index)
+        total_msgs = None
+        logging.info(f"streaming messages from {args.src_mbox}")
+    else:
+        # iterdir() order is arbitrary; import in mailbox order, like --stream
+        msg_files = sorted((f for f in workdir.iterdir() if f.name.isdigit()), key=lambda f: int(f.name))
+        msg_files = [str(f) for f in msg_files]
+        msgs = iter(msg_files)
+        total_msgs = len(msg_files)
+        logging.info(f"{len(msg_files)} messages to work on")
+
+    def on_done(success, done_msg, attempts):
+        msg_index = message_index(done_msg)
+        if index is not None:
+            index.set_status(msg_index, MboxIndex.IMPORTED if success else MboxIndex.FAILED)
+        message_id, dedup_key = read_message_identity(done_msg, mbox_fd)
+        state = "imported" if success else "failed"
+        journal.record(mbox_key, msg_index, message_id, dedup_key, args.dst_group, state, attempts)
+        if success and isinstance(done_msg, str):
+            Path(done_msg).unlink()
+
+    def on_duplicate(dup_msg):
+        nonlocal num_duplicates
+        num_duplicates += 1
+        msg_index = message_index(dup_msg)
+        if isinstance(dup_msg, MboxMessage):
+            index.set_status(msg_index, MboxIndex.DUPLICATE)
+        message_id, dedup_key = read_message_identity(dup_msg, mbox_fd)
+        logging.debug(f"skipping duplicate {dup_msg} {message_id}")
+        journal.record(mbox_key, msg_index, message_id, dedup_key, args.dst_group, "duplicate", [])
+        if isinstance(dup_msg, str):
+            Path(dup_msg).unlink()
+
+    def on_unfixable(bad_msg, reason):
+        nonlocal num_quarantined
+        num_quarantined += 1
+        msg_index = message_index(bad_msg)
+        logging.info(f"quarantining {bad_msg}: {reason}")
+        quarantine_dir.mkdir(parents=True, exist_ok=True)
+        message_id, dedup_key = read_message_identity(bad_msg, mbox_fd)
+        if isinstance(bad_msg, str):
+            Path(bad_msg).rename(quarantine_dir / str(msg_index))
+        else:
+            if isinstance(bad_msg, MboxMessage):
+                index.set_status(msg_index, MboxIndex.QUARANTINED)
+            (quarantine_dir / str(msg_index)).write_bytes(read_message(bad_msg, mbox_fd))
+        journal.record(mbox_key, msg_index, message_id, dedup_key, args.dst_group, "quarantined", [])
+
+    def check_sizes(msgs):
+        nonlocal num_oversized
+        for msg in msgs:
+            size = message_size(msg)
+            if size > MAX_MESSAGE_SIZE:
+                num_oversized += 1
+                logging.info(f"{msg} is {size} bytes, more than the maximum allowed; it will be shrunk")
+            yield msg
+
+    def track_progress(msgs):
+        nonlocal num_dispatched, mbox_position
+        for msg in msgs:
+            num_dispatched += 1
+            if isinstance(msg, MboxMessage):
+                mbox_position = msg.offset + msg.length
+            yield msg
+
+    def progress():
+        if total_msgs is None:
+            return mbox_position / mbox_size if mbox_size else None
+        return num_dispatched / total_msgs if total_msgs else None
+
+    if args.newest_first or args.recent_months or args.priority:
+        priority = load_priority_function(args.priority) if args.priority else None
+        msgs = schedule_messages(msgs, mbox_fd, args.recent_months, priority)
+        total_msgs = len(msgs)
+
+    num_dispatched = 0
+    mbox_position = 0
+    mbox_size = os.path.getsize(args.src_mbox) if index is not None else None
+    num_duplicates = 0
+    num_oversized = 0
+    if args.dedup:
+        seen = journal.imported_keys(args.dst_group)
+        logging.info(f"{len(seen)} messages already imported into {args.dst_group} according to journal")
+        msgs = dedup_messages(msgs, seen, mbox_fd, on_duplicate)
+    num_quarantined = 0
+    quarantine_dir = workdir / "quarantine"
+    if args.normalize:
+        mbox_path = args.src_mbox if index is not None else None
+        msgs = normalize_messages(msgs, mbox_path, workdir / "repaired", args.normalize_procs, on_unfixable)
+    msgs = track_progress(check_sizes(msgs))
+    metrics = ImportMetrics({"group": args.dst_group})
+    metrics.progress = progress
+    reporter = MetricsReporter(metrics, args.metrics_interval, args.metrics_file)
+    reporter.start()
+
+    try:
+        processed_msgs = run_engine(args, msgs, on_done, ratelimiter, metrics, token_broker, timings)
+    finally:
+        reporter.stop()
+        journal.close()
+    logging.info(f"{processed_msgs} messages processed")
+    if args.dedup:
+        logging.info(f"{num_duplicates} duplicates skipped, saving at least as many API calls")
+    if num_oversized:
+        logging.info(f"{num_oversized} messages were too big and had to be shrunk")
+    if num_quarantined:
+        logging.info(f"{num_quarantined} messages couldn't be repaired and were moved to {quarantine_dir}")
+
+    if index is not None:
+        index.close()
+        os.close(mbox_fd)
+
+
+def import_lane(args, ratelimiter, token_broker):
+    """Entry point of a batch import lane process"""
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format=f"%(asctime)-23s %(levelname)s [{args.dst_group}] %(message)s",
+        force=True,
+    )
+    try:
+        with profiling(args.profile, f"manager-{args.dst_group}-{os.getpid()}") as timings:
+            import_archive(args, ratelimiter, token_broker, timings)
+    except ImportAborted as e:
+        logging.error(e)
+        sys.exit(1)
+
+
+def read_manifest(path):
+    """Return list of (mbox path, group) pairs from manifest file path. Each
+    line of the manifest holds an mbox path and a group ID separated by
+    whitespace. Blank lines and lines starting with # are ignored.
+    Raise ImportAborted if the manifest is invalid."""
+    entries = []
+    for lineno, line in enumerate(Path(path).read_text().splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ImportAborted(f"{path}:{lineno}: expected mbox path and group ID")
+        if not Path(fields[0]).is_file():
+            raise ImportAborted(f"{path}:{lineno}: {fields[0]} does not exist")
+        entries.append(tuple(fields))
+    groups = [group for _, group in entries]
+    if len(set(groups)) != len(groups):
+        raise ImportAborted(f"{path}: each group may appear only once")
+    return entries
+
+
+def import_manifest(args, ratelimiter, token_broker=None):
+    """Import every (mbox, group) pair of manifest args.manifest in its own
+    lane process, running up to args.max_lanes lanes at a time. Messages
+    of a lane are inserted into its group as configured by args (normally
+    serially), but lanes proceed independently of each other under the
+    common rate budgets of ratelimiter, and get access tokens from the
+    common token_broker. Return the number of failed lanes."""
+    entries = read_manifest(args.manifest)
+    base_workdir = Path(args.work_dir)
+    base_workdir.mkdir(parents=True, exist_ok=True)
+    pending = deque(entries)
+    running = {}
+    failed = []
+    logging.info(f"importing {len(entries)} archives, up to {args.max_lanes} at a time")
+    while pending or running:
+        while pending and len(running) < args.max_lanes:
+            mbox_path, group = pending.popleft()
+            lane_args = argparse.Namespace(**vars(args))
+            lane_args.src_mbox, lane_args.dst_group = mbox_path, group
+            lane_args.work_dir = str(base_workdir / group)
+            if args.metrics_file:
+                metrics_path = Path(args.metrics_file)
+                lane_args.metrics_file = str(metrics_path.with_stem(f"{metrics_path.stem}.{group}"))
+            lane = Process(target=import_lane, args=(lane_args, ratelimiter, token_broker), name=group)
+            lane.start()
+            running[lane.sentinel] = lane
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            lane = running.pop(sentinel)
+            lane.join()
+            if lane.exitcode:
+                failed.append(lane.name)
+            logging.info(
+                f"lane {lane.name} {'failed' if lane.exitcode else 'finished'}; "
+                f"{len(entries) - len(pending) - len(running)} of {len(entries)} archives done"
+            )
+    if failed:
+        logging.error(f"{len(failed)} archives failed to import: {' '.join(failed)}")
+    return len(failed)
+
+
+def iter_message_headers(mbox_path):
+    """Yield (header, size, read) of every message of mbox mailbox mbox_path,
+    where header is the beginning of the message, long enough to hold its
+    header, and read() returns the whole message. Unless read() is called,
+    message bodies are only read if the mailbox is compressed."""
+    compressed = open_compressed_mbox(mbox_path)
+    if compressed:
+        with compressed:
+            for msg_bytes in iter_mbox_stream(compressed):
+                yield msg_bytes[:HEADER_READ_SIZE], len(msg_bytes), lambda msg_bytes=msg_bytes: msg_bytes
+        return
+    if not os.path.getsize(mbox_path):
+        return
+    with open(mbox_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for offset, length in iter_mbox_messages(mm):
+            header = mm[offset : offset + min(length, HEADER_READ_SIZE)]
+            yield header, length, lambda offset=offset, length=length: mm[offset : offset + length]
+
+
+def plan_archive(mbox_path):
+    """Return dict of statistics of mbox mailbox mbox_path relevant to
+    planning its import. Duplicates are counted by the same dedup keys as
+    --dedup uses (see read_message_identity()), so only messages without a
+    Message-ID are read in full."""
+    sizes = []
+    dedup_keys = set()
+    num_duplicates = 0
+    num_without_msgid = 0
+    first_date = last_date = None
+    num_undated = 0
+    for header, size, read in iter_message_headers(mbox_path):
+        sizes.append(size)
+        header = header[: header.find(b"\n\n") + 1 or None]
+        msgid = get_message_id(header)
+        if msgid is not None:
+            key = b"i" + msgid
+        else:
+            num_without_msgid += 1
+            key = b"c" + hashlib.blake2b(read(), digest_size=16).digest()
+        num_duplicates += key in dedup_keys
+        dedup_keys.add(key)
+        match = DATE_RE.search(header)
+        try:
+            date = email.utils.parsedate_to_datetime(match.group(1).decode(errors="replace"))
+        except (AttributeError, TypeError, ValueError, IndexError):
+            num_undated += 1
+            continue
+        date = date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+        first_date = min(first_date or date, date)
+        last_date = max(last_date or date, date)
+    sizes.sort()
+    return {
+        "messages": len(sizes),
+        "duplicates": num_duplicates,
+        "without_msgid": num_without_msgid,
+        "oversized": sum(size > MAX_MESSAGE_SIZE for size in sizes),
+        "total_size": sum(sizes),
+        "size_percentiles": {
+            q: sizes[min(len(sizes) - 1, int(q / 100 * len(sizes)))] for q in (50, 90, 99) if sizes
+        },
+        "max_size": sizes[-1] if sizes else 0,
+        "first_date": first_date,
+        "last_date": last_date,
+        "undated": num_undated,
+    }
+
+
+def format_size(size):
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1000 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1000
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02}m" if hours else f"{minutes}m {seconds:02}s"
+
+
+def plan_imports(args):
+    """Print what importing the archives given by command line arguments args
+    would entail and how long it would take, without importing anything"""
+    entries = read_manifest(args.manifest) if args.manifest else [(args.src_mbox, args.dst_group)]
+    total_requests = 0
+    for mbox_path, group in entries:
+        with Timer() as timer:
+            plan = plan_archive(mbox_path)
+        num_requests = plan["messages"] - (plan["duplicates"] if args.dedup else 0)
+        total_requests += num_requests
+        duration = num_requests * max(1 / args.max_rate, args.plan_latency / args.num_workers)
+        percentiles = [f"p{q} {format_size(size)}" for q, size in plan["size_percentiles"].items()]
+        percentiles = ", ".join(percentiles + [f"max {format_size(plan['max_size'])}"])
+        print(f"{mbox_path}{f' -> {group}' if group else ''} (scanned in {timer.elapsed:.1f}s)")
+        print(
+            f"  messages:  {plan['messages']}, {plan['without_msgid']} without Message-ID, "
+            f"{plan['duplicates']} duplicates"
+        )
+        print(f"  oversized: {plan['oversized']} over {format_size(MAX_MESSAGE_SIZE)} will be shrunk")
+        print(f"  size:      {format_size(plan['total_size'])} total; {percentiles}")
+        if plan["first_date"]:
+            print(
+                f"  dates:     {plan['first_date']:%Y-%m-%d} to {plan['last_date']:%Y-%m-%d}, "
+                f"{plan['undated']} without valid Date"
+            )
+        print(f"  estimate:  {num_requests} requests, {format_duration(duration)}")
+    print(
+        f"Estimates assume {args.plan_latency}s per request, {args.num_workers} concurrent requests "
+        f"per archive, at most {args.max_rate} requests/s, and no retries."
+    )
+    if len(entries) > 1:
+        lanes = min(args.max_lanes, len(entries))
+        total_duration = total_requests * max(1 / args.max_rate, args.plan_latency / args.num_workers / lanes)
+        print(f"Total: {total_requests} requests, {format_duration(total_duration)} with {lanes} lanes")
 
 
 def main():
@@ -185,6 +2055,8 @@ def main():
             "[2] The delegator account needs to have a Google Workspace admin role.\n"
             "[3] Officially, parallel insertions are not supported. However, sometimes\n"
             "    using multiple workers results in significant peformance improvement.\n"
+            "[4] Officially, Google Groups Migration API calls are limited to 10/s.\n"
+            "[5] Every message costs at least one API call, even if it's a duplicate.\n"
             "\nAlso note that importing the same message (same Message-ID) multiple\n"
             "times will not result in duplicates."
         ),
@@ -193,44 +2065,229 @@ def main():
     parser.add_argument(
         "--sa-creds",
         metavar="PATH",
-        required=True,
         help="service account credentials JSON¹",
     )
     parser.add_argument(
         "--sa-delegator",
         metavar="EMAIL",
-        required=True,
         help="the principal whom the service account\n        will impersonate²",
     )
     parser.add_argument(
         "--src-mbox",
         metavar="PATH",
-        required=True,
-        help="source email archive in mbox format",
+        help="source email archive in mbox format, optionally\n"
+        "compressed (.gz, .xz or .zst)",
     )
     parser.add_argument(
         "--dst-group",
         metavar="EMAIL",
-        required=True,
         help="destination group ID",
     )
+    parser.add_argument(
+        "--manifest",
+        metavar="PATH",
+        help="import many archives instead of --src-mbox into\n"
+        "--dst-group; each line of PATH holds an mbox\n"
+        "path and a group ID separated by whitespace.\n"
+        "Each archive gets its own subdirectory of\n"
+        "--work-dir and is imported independently,\n"
+        "under a common --max-rate",
+    )
+    parser.add_argument(
+        "--max-lanes",
+        metavar="NUM",
+        default=8,
+        type=int,
+        help="maximum number of archives to import at\n"
+        "the same time with --manifest (default: %(default)s)",
+    )
     parser.add_argument(
         "--work-dir",
         metavar="PATH",
         default="./workdir",
-        help="storage for unpacked mailbox (default: ./workdir)",
+        help="storage for unpacked mailbox or, with --stream,\n"
+        "its index (default: ./workdir)",
     )
     parser.add_argument(
         "--resume",
         action="store_true",
-        help="resume using previously unpacked mailbox",
+        help="resume using previously unpacked mailbox or,\n"
+        "with --stream, previously indexed mailbox (or,\n"
+        "if it's compressed, the journal)",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="PATH",
+        help="SQLite database where to record the outcome\n"
+        "of every message and request attempt (default:\n"
+        "./journals/DST_GROUP.sqlite, shared by all\n"
+        "imports into DST_GROUP, whatever their --work-dir)",
+    )
+    parser.add_argument(
+        "--replay-failed",
+        action="store_true",
+        help="only re-submit messages recorded as failed\n"
+        "in the journal (implies --resume)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="skip messages whose Message-ID (or content, if\n"
+        "there is no Message-ID) was seen earlier in the\n"
+        "mailbox or, according to the journal, has already\n"
+        "been imported into --dst-group by an earlier run\n"
+        "using the same --journal, e.g. the default one⁵",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="upload messages straight from --src-mbox\n"
+        "without unpacking it into --work-dir; compressed\n"
+        "mailboxes are decompressed into memory one\n"
+        "message at a time",
+    )
+    parser.add_argument(
+        "--unpack-procs",
+        metavar="NUM",
+        default=os.cpu_count(),
+        type=int,
+        help="number of processes to use for unpacking\n"
+        "--src-mbox (default: number of CPUs)",
     )
     parser.add_argument(
         "--num-workers",
         metavar="NUM",
         default=1,
         type=int,
-        help="number of workers³ (default: 1)",
+        help="number of workers³, or of concurrent requests\n"
+        "with --engine asyncio (default: 1)",
+    )
+    parser.add_argument(
+        "--engine",
+        default="processes",
+        choices=("processes", "asyncio"),
+        help="run workers as separate processes, or as coroutines\n"
+        "sharing a pool of HTTP connections in a single\n"
+        "process (default: processes)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adjust the number of active workers automatically\n"
+        "between 1 and --num-workers based on throttling\n"
+        "and latency",
+    )
+    parser.add_argument(
+        "--worker-credit",
+        metavar="NUM",
+        default=1,
+        type=int,
+        help="number of messages each worker may hold\n"
+        "at a time (default: 1)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        metavar="NUM",
+        default=GOOGLE_API_BUDGETS["groupsmigration"][0],
+        type=float,
+        help="maximum number of API requests per second,\n"
+        "including retries, across all workers⁴ (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--burst",
+        metavar="NUM",
+        default=GOOGLE_API_BUDGETS["groupsmigration"][1],
+        type=int,
+        help="number of API requests that may be sent at once\n"
+        "before --max-rate applies (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="repair messages before uploading them: add\n"
+        "missing Message-IDs, encode 8-bit headers, fix\n"
+        "line endings and broken MIME structure. Messages\n"
+        "that can't be repaired are moved to the\n"
+        "quarantine subdirectory of --work-dir",
+    )
+    parser.add_argument(
+        "--normalize-procs",
+        metavar="NUM",
+        default=os.cpu_count(),
+        type=int,
+        help="number of processes to use for --normalize\n(default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--newest-first",
+        action="store_true",
+        help="import messages in order of their Date header,\n"
+        "newest first, instead of mailbox order. Headers\n"
+        "of all messages are scanned before import starts",
+    )
+    parser.add_argument(
+        "--recent-months",
+        metavar="NUM",
+        type=int,
+        help="like --newest-first, but only bring forward\n"
+        "messages from the last NUM months, then backfill\n"
+        "the rest of the archive in mailbox order",
+    )
+    parser.add_argument(
+        "--priority",
+        metavar="MODULE:FUNC",
+        help="import messages in order of keys returned by\n"
+        "function FUNC of python module MODULE, lowest\n"
+        "first; FUNC is called with message headers\n"
+        "as email.message.Message",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        metavar="SEC",
+        default=60,
+        type=float,
+        help="how often to log progress and export metrics\n(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="export throughput and latency metrics to PATH,\n"
+        "in Prometheus textfile format if PATH ends\n"
+        "with .prom, otherwise appended as JSON lines",
+    )
+    parser.add_argument(
+        "--api-endpoint",
+        metavar="URL",
+        default=MIGRATION_API_ENDPOINT,
+        help="root URL of Groups Migration API, e.g. of\n"
+        "benchmarks/fake-groupsmigration-server.py\n"
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="profile the manager and every worker process\n"
+        "with cProfile, and write the profiles (.prof),\n"
+        "per-request timings of building, rate limiting\n"
+        "and executing insert requests (.json), and their\n"
+        "summary (summary.txt) to DIR. Profiling slows\n"
+        "down the import",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="don't import anything; scan message headers of\n"
+        "--src-mbox (or --manifest archives) and report\n"
+        "message count, sizes, duplicates, date range and\n"
+        "estimated import time at --max-rate and\n"
+        "--num-workers. Doesn't contact Google, and\n"
+        "doesn't need --dst-group",
+    )
+    parser.add_argument(
+        "--plan-latency",
+        metavar="SEC",
+        default=PLAN_LATENCY,
+        type=float,
+        help="time per insert request to assume for --plan\n(default: %(default)s)",
     )
     parser.add_argument(
         "--log-level",
@@ -239,52 +2296,47 @@ def main():
         help="logging level (default: info)",
     )
     args = parser.parse_args()
+    if not args.plan and not (args.sa_creds and args.sa_delegator):
+        parser.error("--sa-creds and --sa-delegator are required unless --plan is given")
+    if args.manifest and (args.src_mbox or args.dst_group):
+        parser.error("--manifest is mutually exclusive with --src-mbox and --dst-group")
+    if not args.manifest and not (args.src_mbox and (args.dst_group or args.plan)):
+        parser.error("either --manifest or both --src-mbox and --dst-group are required")
+    if args.manifest and not Path(args.manifest).is_file():
+        parser.error(f"{args.manifest} does not exist")
+    if args.plan and args.src_mbox and not Path(args.src_mbox).is_file():
+        parser.error(f"{args.src_mbox} does not exist")  # imports may not need it, with --resume
+    if args.max_rate <= 0:
+        parser.error("--max-rate must be positive")
+    if args.num_workers < 1:
+        parser.error("--num-workers must be at least 1")
 
     logging.basicConfig(
         level=getattr(logging, args.log_level.upper()),
         format="%(asctime)-23s %(levelname)s %(message)s",
     )
 
-    if args.resume:
-        logging.info("ignoring --src-mbox because --resume is specified")
-    else:
+    if args.plan:
         try:
-            unpack_mbox(args.src_mbox, args.work_dir)
-        except WorkingDirectoryNotEmpty:
-            parser.exit(1, "Error: working directory is not empty but --resume not given")
-    msg_files = [str(f) for f in Path(args.work_dir).iterdir()]
-    total_files = len(msg_files)
-    processed_files = 0
-    logging.info(f"{total_files} messages to work on")
-
-    work_q = Queue()  # message file names for workers to work on (input)
-    feedback_q = Queue()  # message file names from workers after they've been imported
-    ready_q = Queue()  # qlen is the number of workers ready and waiting for work
-    backoff_q = Queue()  # qlen is the number of workers retransmitting and backing off
-
-    args1 = (work_q, feedback_q, ready_q, backoff_q)
-    args2 = (args.dst_group, args.sa_creds, args.sa_delegator)
-    procs = [Process(target=worker, args=args1 + args2) for i in range(args.num_workers)]
-    [p.start() for p in procs]
-
-    MAX_REQ_RATE = 10  # Officially Google Group Migration API calls are limited to 10/s
-    ratelimiter = RateLimiter(MAX_REQ_RATE, 1)
-    while True:
-        if msg_files and ready_q.qsize() and work_q.empty() and backoff_q.empty():
-            ratelimiter.wait_for_clearance()
-            ratelimiter.register()
-            work_q.put(str(msg_files.pop(0)))
-        while feedback_q.qsize():
-            success, done_msg_file = feedback_q.get()
-            if success:
-                Path(done_msg_file).unlink()
-            processed_files += 1
-        if processed_files == total_files:
-            break
-        sleep(0.01)
-
-    [work_q.put(None) for p in procs]
-    [p.join() for p in procs]
+            return plan_imports(args)
+        except ImportAborted as e:
+            parser.exit(1, f"Error: {e}")
+
+    budgets = GOOGLE_API_BUDGETS | {"groupsmigration": (args.max_rate, args.burst)}
+    ratelimiter = TokenBucketRateLimiter(budgets)
+    with TokenBrokerManager() as broker_manager:
+        token_broker = broker_manager.TokenBroker()
+        try:
+            if args.manifest:
+                return 1 if import_manifest(args, ratelimiter, token_broker) else 0
+            with profiling(args.profile, f"manager-{os.getpid()}") as timings:
+                import_archive(args, ratelimiter, token_broker, timings)
+        except ImportAborted as e:
+            parser.exit(1, f"Error: {e}")
+        finally:
+            if args.profile and Path(args.profile).is_dir():
+                write_profile_summary(args.profile)
+                logging.info(f"profiles and their summary written to {args.profile}")
 
 
 if __name__ == "__main__":
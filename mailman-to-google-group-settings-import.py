@@ -15,7 +15,7 @@ from googleapiclient import discovery
 # noinspection PyPackageRequirements
 from googleapiclient.errors import HttpError
 
-from utils import get_google_group_config_from_mailman_config
+from utils import TokenBucketRateLimiter, get_google_group_config_from_mailman_config
 
 
 handler = colorlog.StreamHandler()
@@ -171,9 +171,11 @@ def main():
         args.sa_creds, scopes=scopes, subject=args.sa_delegate
     )
 
+    ratelimiter = TokenBucketRateLimiter()
     svc = discovery.build("admin", "directory_v1", credentials=creds, cache_discovery=False)
     try:
         logger.info(f"Creating group {ggcfg['email']}")
+        ratelimiter.acquire("directory")
         svc.groups().insert(
             body={
                 "description": ggcfg["description"],
@@ -192,6 +194,7 @@ def main():
     svc = discovery.build("groupssettings", "v1", credentials=creds, cache_discovery=False)
     try:
         logger.info(f"Configuring Google group {ggcfg['email']}")
+        ratelimiter.acquire("groupssettings")
         svc.groups().patch(
             groupUniqueId=ggcfg["email"],
             body=ggcfg,
@@ -203,6 +206,7 @@ def main():
         svc = discovery.build("admin", "directory_v1", credentials=creds, cache_discovery=False)
         members = svc.members()
         logger.info(f"Adding owner {args.add_owner}")
+        ratelimiter.acquire("directory")
         try:
             members.insert(
                 groupKey=ggcfg["email"],
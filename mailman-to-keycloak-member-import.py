@@ -13,6 +13,8 @@ from krs.token import get_rest_client
 from krs.groups import create_group, add_user_group
 from krs.users import list_users
 
+from utils import EmailIndex, canonical_email, format_email_entries
+
 cca_logger = logging.getLogger('ClientCredentialsAuth')
 cca_logger.setLevel('WARNING')
 
@@ -164,12 +166,12 @@ async def mailman_to_keycloak_member_import(
     logger.info(f"Retrieving info of all users from KeyCloak")
     all_users = await list_users(rest_client=keycloak)
     username_from_canon_addr = {
-        u["attributes"]["canonical_email"]: u["username"]
+        canonical_email(u["attributes"]["canonical_email"]): u["username"]
         for u in all_users.values()
         if "canonical_email" in u["attributes"]
     }
     username_from_list_addr = {
-        u["attributes"]["mailing_list_email"]: u["username"]
+        canonical_email(u["attributes"]["mailing_list_email"]): u["username"]
         for u in all_users.values()
         if u["attributes"].get("mailing_list_email")
     }
@@ -184,11 +186,17 @@ async def mailman_to_keycloak_member_import(
         else:
             logger.info(f"Ignoring invalid non-member email {nonmember}")
 
+    subscribers = EmailIndex(mmcfg["digest_members"], "digest_members")
+    subscribers.update(mmcfg["regular_members"], "regular_members")
+    subscribers.update(allowed_non_members, "accept_these_nonmembers")
+    for entries in subscribers.collisions().values():
+        logger.warning(f"Treating {format_email_entries(entries)} as one subscriber {entries[0][0]}")
+
     send_regular_instructions_to = set()
-    for email in mmcfg["digest_members"] + mmcfg["regular_members"] + allowed_non_members:
-        username, domain = email.split("@")
+    for email in subscribers:
+        username, domain = canonical_email(email).split("@")
         if domain == "icecube.wisc.edu":
-            username = username_from_email.get(email, username)
+            username = username_from_email.get(canonical_email(email), username)
             if username not in all_users:
                 logger.warning(f"Unknown user {email}")
                 logger.info(f"Needs instructions unknown {email}")
@@ -223,11 +231,16 @@ async def mailman_to_keycloak_member_import(
                 ),
             )
 
+    owners = EmailIndex(mmcfg["owner"], "owner")
+    owners.update(mmcfg["moderator"], "moderator")
+    for entries in owners.collisions().values():
+        logger.warning(f"Treating {format_email_entries(entries)} as one owner {entries[0][0]}")
+
     send_owner_instructions_to = set()
-    for email in set(mmcfg["owner"] + mmcfg["moderator"]):
-        username, domain = email.split("@")
+    for email in owners:
+        username, domain = canonical_email(email).split("@")
         if domain == "icecube.wisc.edu":
-            username = username_from_email.get(email, username)
+            username = username_from_email.get(canonical_email(email), username)
             if username not in all_users:
                 logger.warning(f"Unknown owner {email}")
                 send_owner_instructions_to.add(email)
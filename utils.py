@@ -1,3 +1,134 @@
+import asyncio
+import multiprocessing
+
+from time import monotonic, sleep
+
+# Default per-API request budgets as (requests per second, burst capacity).
+# The groupsmigration limit is documented; the others are conservative
+# fractions of the default per-user quotas.
+GOOGLE_API_BUDGETS = {
+    "groupsmigration": (10, 10),
+    "directory": (20, 40),
+    "groupssettings": (5, 10),
+}
+
+# Email domains that are aliases of another domain
+EMAIL_DOMAIN_ALIASES = {"googlemail.com": "gmail.com"}
+# Email domains that ignore dots in the local part of addresses
+DOTLESS_EMAIL_DOMAINS = {"gmail.com"}
+
+
+class TokenBucketRateLimiter:
+    """Token bucket rate limiter that can be shared by multiple processes.
+
+    Every named budget is a bucket that holds up to "burst" tokens and refills
+    at "rate" tokens per second. Each request takes a token out of its budget's
+    bucket, waiting if necessary. Bucket state is kept in shared memory, so an
+    instance passed to child processes as a Process argument enforces the
+    budgets across all of them.
+    """
+
+    def __init__(self, budgets=GOOGLE_API_BUDGETS):
+        """Create buckets for budgets, a dict of name -> (rate, burst)"""
+        self.slots = {name: i for i, name in enumerate(budgets)}
+        self.params = [budgets[name] for name in budgets]
+        # tokens currently in the bucket, and when that was last computed
+        self.state = multiprocessing.RawArray("d", 2 * len(budgets))
+        self.lock = multiprocessing.Lock()
+        now = monotonic()
+        for i, (rate, burst) in enumerate(self.params):
+            self.state[2 * i] = burst
+            self.state[2 * i + 1] = now
+
+    def _take(self, slot, tokens):
+        """Take tokens if available; otherwise return how long to wait for them"""
+        rate, burst = self.params[slot]
+        with self.lock:
+            now = monotonic()
+            available = min(burst, self.state[2 * slot] + (now - self.state[2 * slot + 1]) * rate)
+            self.state[2 * slot + 1] = now
+            if available >= tokens:
+                self.state[2 * slot] = available - tokens
+                return 0
+            self.state[2 * slot] = available
+            return (tokens - available) / rate
+
+    def acquire(self, budget, tokens=1):
+        """Wait until budget has tokens available, and take them"""
+        slot = self.slots[budget]
+        if tokens > self.params[slot][1]:
+            raise ValueError(f"{tokens} tokens exceed burst capacity of budget {budget}")
+        while delay := self._take(slot, tokens):
+            sleep(delay)
+
+    async def acquire_async(self, budget, tokens=1):
+        """Like acquire(), but wait without blocking the event loop"""
+        slot = self.slots[budget]
+        if tokens > self.params[slot][1]:
+            raise ValueError(f"{tokens} tokens exceed burst capacity of budget {budget}")
+        while delay := self._take(slot, tokens):
+            await asyncio.sleep(delay)
+
+
+def canonical_email(address):
+    """Return canonical form of email address, which is the same for variants
+    of an address that reach the same mailbox: surrounding whitespace is
+    removed, case is folded, domain aliases (googlemail.com) are resolved,
+    and dots are removed from local parts of domains that ignore them (gmail.com).
+    Subaddresses (user+tag@) are kept, since their owners chose them on purpose."""
+    local, at, domain = address.strip().lower().rpartition("@")
+    if not at:
+        return domain
+    domain = EMAIL_DOMAIN_ALIASES.get(domain, domain)
+    if domain in DOTLESS_EMAIL_DOMAINS:
+        local = local.replace(".", "")
+    return f"{local}@{domain}"
+
+
+class EmailIndex:
+    """Hash map of canonical email addresses (see canonical_email()) to the
+    (raw address, source) entries under which they were added, in order of
+    addition. Used to make one API operation per actual address and to
+    report addresses that were given more than once, in the same form or
+    not (e.g. in both digest and regular members)."""
+
+    def __init__(self, addresses=(), source=None):
+        self.entries = {}
+        self.update(addresses, source)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, address):
+        return canonical_email(address) in self.entries
+
+    def __iter__(self):
+        """Iterate over the first-added variant of every address"""
+        return (entries[0][0] for entries in self.entries.values())
+
+    def add(self, address, source=None):
+        """Add address, which came from source (e.g. the name of the list it
+        is in), and return its canonical form"""
+        canonical = canonical_email(address)
+        self.entries.setdefault(canonical, []).append((address, source))
+        return canonical
+
+    def update(self, addresses, source=None):
+        """Add every address of addresses, which came from source"""
+        for address in addresses:
+            self.add(address, source)
+
+    def collisions(self):
+        """Return dict of canonical address -> (address, source) entries for
+        addresses that were added more than once"""
+        return {canonical: entries for canonical, entries in self.entries.items() if len(entries) > 1}
+
+
+def format_email_entries(entries):
+    """Return (address, source) entries of EmailIndex as a readable string"""
+    return ", ".join(f"{address} ({source})" if source else address for address, source in entries)
+
+
 def get_google_group_config_from_mailman_config(mmcfg):
     # https://developers.google.com/admin-sdk/groups-settings/v1/reference/groups#json
     if mmcfg["advertised"] and mmcfg["archive"]: